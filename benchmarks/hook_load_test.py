@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+'''Load test for the post-consume hook.
+
+Simulates a burst of documents being consumed by Paperless-ngx: a fake Paperless-ngx REST API is
+started locally (answering each request after a configurable latency), and then the hook is run
+once per document, with the same environment variables and arguments Paperless-ngx would use, by
+a configurable number of consumer workers. Reports the per-document hook latency, how long it took
+to drain the whole burst, and where the hook spent its time.
+
+Example:
+    ./benchmarks/hook_load_test.py --documents 50 --workers 2 --latency 0.02
+'''
+
+import argparse
+import concurrent.futures
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+CORRESPONDENTS = ["The Bank", "The Utility Company", "The Insurance Company", "The Landlord", "The Employer"]
+DOCUMENT_TYPES = ["Transfer Confirmation", "Invoice", "Statement", "Letter", "Payslip"]
+TAGS = ["Inbox", "Taxes", "Paid", "Important", "Postprocessed", "Invalid"]
+
+
+class FakePaperless:
+    '''Just enough of the Paperless-ngx REST API for the hook, with the given latency added to each response'''
+    def __init__(self, num_documents, latency, jitter, content_size):
+        self.latency = latency
+        self.jitter = jitter
+        # Like Paperless-ngx (unless PAPERLESS_ENABLE_COMPRESSION is off), gzip responses for clients that accept it
+        self.compress = True
+        self.lock = threading.Lock()
+        self.request_counts = {}
+        self.items = {"correspondents": [{"id": i + 1, "name": name} for i, name in enumerate(CORRESPONDENTS)],
+                      "document_types": [{"id": i + 1, "name": name} for i, name in enumerate(DOCUMENT_TYPES)],
+                      "storage_paths": [],
+                      "tags": [{"id": i + 1, "name": name} for i, name in enumerate(TAGS)]}
+        random.seed(0)
+        self.documents = {}
+        for document_id in range(1, num_documents + 1):
+            created = f"20{random.randint(10, 23)}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}"
+            content = f"From The Other Bank\nthrough March 5, 21\n" + "lorem ipsum dolor sit amet " * (content_size // 27)
+            self.documents[document_id] = {"id": document_id,
+                                            "correspondent": random.randint(1, len(CORRESPONDENTS)),
+                                            "document_type": random.randint(1, len(DOCUMENT_TYPES)),
+                                            "storage_path": None,
+                                            "archive_serial_number": None,
+                                            "tags": [1],
+                                            "title": f"{created} scan {document_id}",
+                                            "content": content,
+                                            "created": f"{created}T00:00:00+00:00",
+                                            "created_date": created,
+                                            "modified": f"{created}T00:00:00+00:00",
+                                            "added": f"{created}T00:00:00+00:00",
+                                            "original_file_name": f"scan-{document_id}.pdf"}
+
+    def _count(self, kind):
+        with self.lock:
+            self.request_counts[kind] = self.request_counts.get(kind, 0) + 1
+
+    def handle(self, method, path, query, body):
+        '''Returns (status, json_response) for a request'''
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        parts = [part for part in path.split("/") if part != ""]
+        if len(parts) < 2 or parts[0] != "api":
+            return 404, {"detail": "Not found."}
+        item_type = parts[1]
+        self._count(f"{method} {item_type}{'/' + '<id>' if len(parts) > 2 else ''}{'/' + parts[3] if len(parts) > 3 else ''}")
+
+        if item_type == "documents":
+            if len(parts) == 2:
+                return 200, self._list(item_type, list(self.documents.values()), query)
+            document = self.documents.get(int(parts[2]))
+            if document is None:
+                return 404, {"detail": "Not found."}
+            if len(parts) == 4 and parts[3] == "metadata":
+                return 200, {"media_filename": f"{document['id']:07d}.pdf",
+                             "has_archive_version": True,
+                             "archive_media_filename": f"{document['id']:07d}.pdf"}
+            if method == "PATCH":
+                with self.lock:
+                    document.update({key: value for key, value in body.items() if key in document})
+                    if "created_date" in body:
+                        document["created"] = f"{body['created_date']}T00:00:00+00:00"
+            return 200, self._fields(document, query)
+
+        if item_type in self.items:
+            if len(parts) == 2:
+                items = self.items[item_type]
+                if "name__iexact" in query:
+                    items = [item for item in items if item["name"].lower() == query["name__iexact"][0].lower()]
+                return 200, self._list(item_type, items, query)
+            item = next((item for item in self.items[item_type] if item["id"] == int(parts[2])), None)
+            return (200, item) if item is not None else (404, {"detail": "Not found."})
+
+        return 404, {"detail": "Not found."}
+
+    def _fields(self, document, query):
+        if "fields" in query:
+            fields = query["fields"][0].split(",")
+            return {key: value for key, value in document.items() if key in fields}
+        return document
+
+    def _list(self, item_type, items, query):
+        for key, field in [("correspondent__id", "correspondent"), ("document_type__id", "document_type")]:
+            if key in query:
+                items = [item for item in items if item.get(field) == int(query[key][0])]
+        if "id__in" in query:
+            document_ids = {int(document_id) for document_id in query["id__in"][0].split(",")}
+            items = [item for item in items if item["id"] in document_ids]
+        if "modified__gt" in query:
+            items = [item for item in items if item.get("modified", "") > query["modified__gt"][0]]
+        page_size = int(query.get("page_size", ["25"])[0])
+        page = int(query.get("page", ["1"])[0])
+        results = [self._fields(item, query) for item in items[(page - 1) * page_size:page * page_size]]
+        return {"count": len(items),
+                "next": None if page * page_size >= len(items) else f"{self.url}/{item_type}/?{urllib.parse.urlencode({**{key: values[0] for key, values in query.items()}, 'page': page + 1})}",
+                "previous": None,
+                "all": [item["id"] for item in items],
+                "results": results}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self):
+                url = urllib.parse.urlsplit(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                raw_body = self.rfile.read(length) if length > 0 else b""
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    body = json.loads(raw_body or b"{}")
+                else:
+                    # requests sends a dict as a form, so every value arrives as a (list of) strings
+                    body = {}
+                    for key, values in urllib.parse.parse_qs(raw_body.decode()).items():
+                        if key == "tags":
+                            body[key] = [int(value) for value in values]
+                        elif key in ["correspondent", "document_type", "storage_path", "archive_serial_number"]:
+                            body[key] = int(values[0]) if values[0].isdigit() else None
+                        else:
+                            body[key] = values[0]
+                status, response = fake.handle(self.command, url.path, urllib.parse.parse_qs(url.query), body)
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if fake.compress and "gzip" in self.headers.get("Accept-Encoding", "") and len(data) >= 200:
+                    data = gzip.compress(data, compresslevel=6)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting, e.g. because the hook ran out of time
+                    pass
+
+            do_GET = _respond
+            do_PATCH = _respond
+            do_POST = _respond
+            do_DELETE = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def percentile(values, fraction):
+    '''Nearest-rank percentile, so e.g. the p99 of 50 latencies is the largest of them rather than an interpolation'''
+    if len(values) == 0:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def run_hook(hook, document, api_url, base_env, timings_filename):
+    '''Runs the hook for one document the way Paperless-ngx does, and returns (start, end, returncode, output)'''
+    document_id = str(document["id"])
+    env = dict(base_env)
+    env.update({"DOCUMENT_ID": document_id,
+                "DOCUMENT_FILE_NAME": document["original_file_name"],
+                "DOCUMENT_CREATED": document["created"],
+                "DOCUMENT_MODIFIED": document["modified"],
+                "DOCUMENT_ADDED": document["added"],
+                "DOCUMENT_SOURCE_PATH": f"/usr/src/paperless/media/documents/originals/{int(document_id):07d}.pdf",
+                "DOCUMENT_ARCHIVE_PATH": f"/usr/src/paperless/media/documents/archive/{int(document_id):07d}.pdf",
+                "DOCUMENT_THUMBNAIL_PATH": f"/usr/src/paperless/media/documents/thumbnails/{int(document_id):07d}.webp",
+                "DOCUMENT_DOWNLOAD_URL": f"/api/documents/{document_id}/download/",
+                "DOCUMENT_THUMBNAIL_URL": f"/api/documents/{document_id}/thumb/",
+                "DOCUMENT_CORRESPONDENT": CORRESPONDENTS[document["correspondent"] - 1],
+                "DOCUMENT_TAGS": TAGS[0],
+                "DOCUMENT_ORIGINAL_FILENAME": document["original_file_name"],
+                "PNGX_POSTPROCESSOR_TIMINGS_FILE": timings_filename})
+    args = [str(hook), env["DOCUMENT_ID"], env["DOCUMENT_FILE_NAME"], env["DOCUMENT_SOURCE_PATH"], env["DOCUMENT_THUMBNAIL_PATH"],
+            env["DOCUMENT_DOWNLOAD_URL"], env["DOCUMENT_THUMBNAIL_URL"], env["DOCUMENT_CORRESPONDENT"], env["DOCUMENT_TAGS"]]
+    start = time.time()
+    result = subprocess.run(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return start, time.time(), result.returncode, result.stdout
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Load test the post-consume hook against a fake Paperless-ngx API")
+    arg_parser.add_argument("--documents", type=int, default=20, help="How many documents are consumed in the burst. (default: %(default)s)")
+    arg_parser.add_argument("--workers", type=int, default=1, help="How many documents Paperless-ngx consumes at once, i.e. PAPERLESS_TASK_WORKERS. (default: %(default)s)")
+    arg_parser.add_argument("--consume-time", type=float, default=0.0, help="Seconds Paperless-ngx itself spends consuming each document before running the hook. (default: %(default)s)")
+    arg_parser.add_argument("--latency", type=float, default=0.01, help="Seconds the fake API takes to answer each request. (default: %(default)s)")
+    arg_parser.add_argument("--jitter", type=float, default=0.0, help="Standard deviation of the fake API's latency, in seconds. (default: %(default)s)")
+    arg_parser.add_argument("--content-size", type=int, default=4096, help="Size in characters of each document's content. (default: %(default)s)")
+    arg_parser.add_argument("--hook", type=str, default=str(REPO_DIR / "post_consume_script.py"), help="The post-consume script to run, e.g. post_consume_script.sh if the venv is set up. (default: %(default)s)")
+    arg_parser.add_argument("--rulesets-dir", type=str, default=str(REPO_DIR / "rulesets.d"), help="The rulesets to use. (default: %(default)s)")
+    arg_parser.add_argument("--post-consume-script", type=str, default=None, help="A user post-consume script for the hook to run afterwards, e.g. /bin/true. (default: none)")
+    arg_parser.add_argument("--detach-post-consume-script", action="store_true", help="Have the hook queue the user post-consume script to run in the background, and also report how long it took until all of them had run.")
+    arg_parser.add_argument("--time-budget", type=float, default=None, help="The hook's time budget in seconds, i.e. PNGX_POSTPROCESSOR_TIME_BUDGET. Documents it runs out of time for are finished in the background. (default: no limit)")
+    arg_parser.add_argument("--json", action="store_true", help="Print the results as json instead of a table.")
+    args = arg_parser.parse_args()
+
+    fake = FakePaperless(args.documents, args.latency, args.jitter, args.content_size)
+    api_url = fake.start()
+
+    with tempfile.TemporaryDirectory(prefix="hook-load-test-") as temp_dir:
+        timings_filename = str(Path(temp_dir) / "timings.jsonl")
+        base_env = {key: value for key, value in os.environ.items() if not key.startswith("PNGX_POSTPROCESSOR_")}
+        base_env.update({"PNGX_POSTPROCESSOR_PAPERLESS_API_URL": api_url,
+                         "PNGX_POSTPROCESSOR_AUTH_TOKEN": "load-test",
+                         "PNGX_POSTPROCESSOR_RULESETS_DIR": args.rulesets_dir,
+                         "PNGX_POSTPROCESSOR_CACHE_DIR": str(Path(temp_dir) / "cache"),
+                         "PNGX_POSTPROCESSOR_SPOOL_DIR": str(Path(temp_dir) / "spool"),
+                         "PNGX_POSTPROCESSOR_POSTPROCESSING_TAG": "Postprocessed",
+                         "PNGX_POSTPROCESSOR_INVALID_TAG": "Invalid",
+                         "MEDIA_ROOT_DIR": "/usr/src/paperless/media"})
+        if args.post_consume_script is not None:
+            base_env["PNGX_POSTPROCESSOR_POST_CONSUME_SCRIPT"] = args.post_consume_script
+        if args.detach_post_consume_script:
+            base_env["PNGX_POSTPROCESSOR_DETACH_POST_CONSUME_SCRIPT"] = "true"
+        if args.time_budget is not None:
+            base_env["PNGX_POSTPROCESSOR_TIME_BUDGET"] = str(args.time_budget)
+
+        documents = [dict(document) for document in fake.documents.values()]
+
+        def consume(document):
+            time.sleep(args.consume_time)
+            return document["id"], run_hook(args.hook, document, api_url, base_env, timings_filename)
+
+        # The whole burst arrives at once, and the consumer works through it args.workers documents at a time
+        burst_start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+            results = dict(executor.map(consume, documents))
+        drain_time = time.time() - burst_start
+
+        background_done_time = None
+        queue_dirs = [Path(temp_dir) / "spool" / name for name in ["post_consume_script", "deferred"]]
+        if any(queue_dir.exists() for queue_dir in queue_dirs):
+            # Detached post-consume scripts and deferred documents are still being worked on in the background, and their queues are in temp_dir, so wait for them to empty
+            while any(any((queue_dir / subdirectory).glob("*.json")) for queue_dir in queue_dirs for subdirectory in ["pending", "working"]):
+                time.sleep(0.05)
+            background_done_time = time.time() - burst_start
+
+        timings = {}
+        if Path(timings_filename).exists():
+            with open(timings_filename, "r") as timings_file:
+                for line in timings_file:
+                    record = json.loads(line)
+                    timings[int(record["document_id"])] = record
+    fake.stop()
+
+    failures = {document_id: result for document_id, result in results.items() if result[2] != 0}
+    for document_id, (_, _, returncode, output) in list(failures.items())[:3]:
+        print(f"Hook failed for document {document_id} with exit code {returncode}:\n{output}", file=sys.stderr)
+
+    latencies = [end - start for start, end, _, _ in results.values()]
+    # Time from the burst arriving until each document's hook is done, which includes waiting in the queue
+    completions = [end - burst_start for _, end, _, _ in results.values()]
+
+    breakdown = {"startup": [], "imports": [], "auth": [], "rule_loading": [], "api_calls": [], "rule_evaluation": [], "post_consume_script": []}
+    for document_id, (start, _, _, _) in results.items():
+        record = timings.get(document_id)
+        if record is None:
+            continue
+        phases = record["phases"]
+        request_times = record["request_times"]
+        breakdown["startup"].append(record["started"] - start)
+        breakdown["imports"].append(phases.get("imports", 0.0))
+        breakdown["auth"].append(phases.get("auth", 0.0))
+        # The requests each phase made are counted in api_calls instead
+        breakdown["rule_loading"].append(phases.get("rule_loading", 0.0) - request_times.get("rule_loading", 0.0))
+        breakdown["api_calls"].append(sum(request_times.values()))
+        breakdown["rule_evaluation"].append(phases.get("postprocessing", 0.0) - request_times.get("postprocessing", 0.0))
+        breakdown["post_consume_script"].append(phases.get("post_consume_script", 0.0) - request_times.get("post_consume_script", 0.0))
+
+    report = {"documents": args.documents,
+              "workers": args.workers,
+              "failures": len(failures),
+              "drain_time": drain_time,
+              "throughput": args.documents / drain_time if drain_time > 0 else float("nan"),
+              "deferred": len([record for record in timings.values() if "deferral" in record["phases"]]),
+              "background_done_time": background_done_time,
+              "hook_latency": {name: percentile(latencies, fraction) for name, fraction in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]},
+              "time_to_done": {name: percentile(completions, fraction) for name, fraction in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]},
+              "breakdown": {phase: {"mean": sum(values) / len(values), "p95": percentile(values, 0.95)} for phase, values in breakdown.items() if len(values) > 0},
+              "requests": fake.request_counts}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{args.documents} documents, {args.workers} worker(s), {args.latency * 1000:.0f}ms API latency, {len(failures)} failure(s)")
+    print(f"Queue drained in {drain_time:.2f}s ({report['throughput']:.2f} documents/s)")
+    if report["deferred"] > 0:
+        print(f"{report['deferred']} document(s) ran out of time budget and were deferred to the background")
+    if background_done_time is not None:
+        print(f"Background work (deferred documents, detached post-consume scripts) all done after {background_done_time:.2f}s")
+    print(f"Hook latency:  p50 {report['hook_latency']['p50'] * 1000:8.1f}ms  p95 {report['hook_latency']['p95'] * 1000:8.1f}ms  p99 {report['hook_latency']['p99'] * 1000:8.1f}ms")
+    print(f"Time to done:  p50 {report['time_to_done']['p50'] * 1000:8.1f}ms  p95 {report['time_to_done']['p95'] * 1000:8.1f}ms  p99 {report['time_to_done']['p99'] * 1000:8.1f}ms")
+    print("Where the hook spends its time (per document):")
+    for phase, values in report["breakdown"].items():
+        print(f"  {phase:<20} mean {values['mean'] * 1000:8.1f}ms  p95 {values['p95'] * 1000:8.1f}ms")
+    print("Requests to the API:")
+    for kind, count in sorted(report["requests"].items()):
+        print(f"  {kind:<30} {count:6d}  ({count / args.documents:.1f} per document)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+'''Benchmark for how much listing documents (with their content) costs on the wire and in json decoding.
+
+Lists every document of a fake Paperless-ngx REST API over HTTP, once without compression, once
+with it, and (if it's installed) once more with orjson decoding the pages instead of python's json
+module. For each, reports how many bytes each page took on the wire and once uncompressed, and how
+long decoding each page took.
+
+The fake runs on localhost, so the network is far faster than a real one would be, and the time
+saved by sending fewer bytes is mostly hidden. The bytes per page show what would be saved, though
+the fake's content is very repetitive, so it compresses much better than real OCR text does.
+
+Example:
+    ./benchmarks/listing_transfer.py --documents 500 --content-size 20000
+'''
+
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from hook_load_test import FakePaperless
+from paperlessngx_postprocessor import PaperlessAPI
+from paperlessngx_postprocessor import paperless_api
+
+
+def run(fake, compress, fast_json, page_size):
+    logger = logging.getLogger("benchmark")
+    logger.setLevel("CRITICAL")
+    saved_fast_json = paperless_api._fast_json
+    paperless_api._fast_json = fast_json
+    try:
+        api = PaperlessAPI(fake.url, auth_token="benchmark", paperless_src_dir=None, logger=logger, response_cache_size=0)
+        if not compress:
+            api._common_headers["Accept-Encoding"] = "identity"
+        start = time.perf_counter()
+        documents = api._get_list("documents", f"page_size={page_size}")
+        elapsed = time.perf_counter() - start
+    finally:
+        paperless_api._fast_json = saved_fast_json
+    return {"documents": len(documents),
+            "pages": api.num_decoded,
+            "bytes_received": api.bytes_received,
+            "bytes_decoded": api.bytes_decoded,
+            "decode_time": api.decode_time,
+            "elapsed": elapsed}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure the bytes on the wire and json decoding time of listing documents")
+    arg_parser.add_argument("--documents", type=int, default=300, help="How many documents to list. (default: %(default)s)")
+    arg_parser.add_argument("--page-size", type=int, default=100, help="How many documents per page. (default: %(default)s)")
+    arg_parser.add_argument("--content-size", type=int, default=20000, help="Size in characters of each document's content. (default: %(default)s)")
+    arg_parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake API takes to answer each request. (default: %(default)s)")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="How many times to repeat each measurement, keeping the fastest. (default: %(default)s)")
+    args = arg_parser.parse_args()
+
+    fake = FakePaperless(args.documents, args.latency, 0.0, args.content_size)
+    fake.start()
+
+    configurations = [("uncompressed, json", False, None), ("compressed, json", True, None)]
+    if paperless_api._fast_json is not None:
+        configurations.append(("compressed, orjson", True, paperless_api._fast_json))
+    else:
+        print("orjson isn't installed, so only python's json module is measured")
+
+    print(f"Listing {args.documents} documents ({args.content_size} characters of content each), {args.page_size} per page (fastest of {args.repeat} runs):")
+    for label, compress, fast_json in configurations:
+        result = min((run(fake, compress, fast_json, args.page_size) for _ in range(args.repeat)), key=lambda result: result["elapsed"])
+        pages = max(1, result["pages"])
+        print(f"  {label:<20} {result['bytes_received'] / pages / 1024:9.1f}KiB per page on the wire ({result['bytes_decoded'] / pages / 1024:.1f}KiB uncompressed)"
+              f"  {result['decode_time'] * 1000 / pages:7.2f}ms per page decoding  {result['elapsed']:6.2f}s in total")
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
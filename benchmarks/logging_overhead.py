@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+'''Benchmark for how much logging costs while postprocessing.
+
+Postprocesses the same set of documents at each log level (and with the per-document info messages
+sampled), against an in-memory fake of the Paperless-ngx REST API so no time goes to the network.
+Log messages are formatted and written to /dev/null, so what's measured is the cost of producing
+them, not of the terminal showing them.
+
+Example:
+    ./benchmarks/logging_overhead.py --documents 500
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import urllib.parse
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from hook_load_test import FakePaperless
+from paperlessngx_postprocessor import PaperlessAPI, Postprocessor
+
+
+class FakeResponse:
+    def __init__(self, method, url, status_code, response):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.reason = "OK" if self.ok else "Error"
+        self.url = url
+        self.headers = {}
+        self.text = json.dumps(response)
+        self.content = self.text.encode()
+        self.request = type("FakeRequest", (), {"method": method})()
+        self._response = response
+
+    def json(self):
+        return self._response
+
+
+class InMemoryPaperlessAPI(PaperlessAPI):
+    '''A PaperlessAPI whose requests are answered directly by a FakePaperless, without going over HTTP'''
+    def __init__(self, fake, logger):
+        super().__init__("http://fake/api", auth_token="benchmark", paperless_src_dir=None, logger=logger)
+        self._fake = fake
+
+    def _send(self, method, url, data=None, **kwargs):
+        split_url = urllib.parse.urlsplit(url)
+        body = dict(data) if data is not None else {}
+        if "tags" in body and not isinstance(body["tags"], list):
+            body["tags"] = [body["tags"]]
+        status_code, response = self._fake.handle(method, split_url.path, urllib.parse.parse_qs(split_url.query), body)
+        return FakeResponse(method, url, status_code, response)
+
+
+def run(level, log_every, num_documents, rulesets_dir, content_size):
+    logger = logging.getLogger(f"benchmark-{level}-{log_every}")
+    logger.propagate = False
+    logger.setLevel(level)
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"))
+    logger.addHandler(handler)
+
+    fake = FakePaperless(num_documents, 0.0, 0.0, content_size)
+    fake.url = "http://fake/api"
+    api = InMemoryPaperlessAPI(fake, logger)
+    postprocessor = Postprocessor(api,
+                                  rulesets_dir,
+                                  postprocessing_tag = "Postprocessed",
+                                  invalid_tag = "Invalid",
+                                  logger = logger,
+                                  log_every = log_every)
+    documents = api.get_all_documents()
+
+    start = time.perf_counter()
+    postprocessor.postprocess(documents)
+    elapsed = time.perf_counter() - start
+
+    logger.removeHandler(handler)
+    handler.stream.close()
+    return elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure the overhead of logging at each level while postprocessing")
+    arg_parser.add_argument("--documents", type=int, default=200, help="How many documents to postprocess at each level. (default: %(default)s)")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="How many times to repeat each measurement, keeping the fastest. (default: %(default)s)")
+    arg_parser.add_argument("--content-size", type=int, default=4096, help="Size in characters of each document's content. (default: %(default)s)")
+    arg_parser.add_argument("--rulesets-dir", type=str, default=str(REPO_DIR / "rulesets.d"), help="The rulesets to use. (default: %(default)s)")
+    args = arg_parser.parse_args()
+
+    configurations = [("CRITICAL", 1), ("WARNING", 1), ("INFO", 100), ("INFO", 1), ("DEBUG", 1)]
+    results = {}
+    for level, log_every in configurations:
+        results[(level, log_every)] = min(run(level, log_every, args.documents, args.rulesets_dir, args.content_size) for _ in range(args.repeat))
+
+    baseline = results[("CRITICAL", 1)]
+    print(f"Postprocessing {args.documents} documents (fastest of {args.repeat} runs):")
+    for (level, log_every), elapsed in results.items():
+        label = level if log_every == 1 else f"{level} (LOG_EVERY={log_every})"
+        print(f"  {label:<25} {elapsed * 1000 / args.documents:8.3f}ms per document  ({(elapsed / baseline - 1) * 100:+6.1f}% vs. CRITICAL)")
+
+
+if __name__ == "__main__":
+    main()
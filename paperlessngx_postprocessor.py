@@ -6,10 +6,12 @@ import sys
 import yaml
 import os
 import copy
+import requests
 
-from paperlessngx_postprocessor import Config, PaperlessAPI, Postprocessor
+from paperlessngx_postprocessor import Config, OfflinePaperlessAPI, PaperlessAPI, PaperlessAPIError, Postprocessor
+from paperlessngx_postprocessor.run_journal import RunJournal, RunProgress
 
-if __name__ == "__main__":
+def main():
     logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s")#, level=logging.DEBUG)
 
     config = Config(Config.general_options())
@@ -20,19 +22,26 @@ if __name__ == "__main__":
     for option_name in config.options_spec.keys():
         arg_parser.add_argument("--" + option_name.replace("_","-"), **config.options_spec[option_name].argparse_args)
 
+    arg_parser.add_argument("--manifest", metavar="MANIFEST", type=str, help="Work offline on a Paperless-ngx export instead of the live server, where MANIFEST is the manifest.json written by Paperless-ngx's document_exporter (or the directory it's in). The changes the rules would make are logged (along with how often each rule matched), but nothing is changed in Paperless-ngx. Useful for quickly trying out new rules on a whole archive.")
+
         #    arg_parser.add_argument("--select", metavar=("ADDITIONAL_SELECTOR", "ITEM_NAME"), nargs=2, action="append", help="Additional optional selectors to apply to narrow the set of documents to apply postprocessing to. Ignored if SELECTOR is one of {all, document_id, restore}. ADDITIONAL_SELECTOR must be one of {correspondent, document_type, tag, storage_path}.")
 
-    subparsers = arg_parser.add_subparsers(dest="mode", title='Modes', help="Use 'process [ARGS]' to choose which documents to process, or 'restore FILENAME' to restore a backup file.")
+    subparsers = arg_parser.add_subparsers(dest="mode", title='Modes', help="Use 'process [ARGS]' to choose which documents to process, 'restore FILENAME' to restore a backup file, or 'merge-backups OUTPUT FILENAME [FILENAME ...]' to combine the backup files written by several shards into one.")
 
     process_subparser = subparsers.add_parser("process", usage=f"{os.path.basename(__file__)} [OPTIONS] process [SELECTORS]", description='Process documents where all the [SELECTORS] match (e.g. a collective "and"). At least one selector is required. If --all or --document-id is given, all the other selectors are ignored. For help with general [OPTIONS], do \'paperlessngx_postprocessor.py --help\'')
     selector_group = process_subparser.add_argument_group(title="SELECTORS")
     selector_config = Config(Config.selector_options(), use_environment_variables=False)
     for option_name in selector_config.options_spec.keys():
         selector_group.add_argument("--" + option_name.replace("_","-"), **selector_config.options_spec[option_name].argparse_args)
+    process_subparser.add_argument("--resume", action="store_true", help="Continue an earlier run with the same SELECTORS that was interrupted, skipping the documents it already finished. Refuses to continue if the rules changed in the meantime.")
 
     restore_subparser = subparsers.add_parser("restore", usage=f"{os.path.basename(__file__)} [OPTIONS] restore FILENAME")
     restore_subparser.add_argument("filename", metavar="FILENAME", type=str, help="Filename of the backup file to restore.")
 
+    merge_subparser = subparsers.add_parser("merge-backups", usage=f"{os.path.basename(__file__)} [OPTIONS] merge-backups OUTPUT FILENAME [FILENAME ...]", description="Combine several backup files (e.g. one from each --shard) into a single backup file that can be restored in one go.")
+    merge_subparser.add_argument("output", metavar="OUTPUT", type=str, help="Filename of the combined backup file to write.")
+    merge_subparser.add_argument("filenames", metavar="FILENAME", type=str, nargs="+", help="Filenames of the backup files to combine.")
+
     cli_options = vars(arg_parser.parse_args())
 
     config.update_options(cli_options)
@@ -43,6 +52,10 @@ if __name__ == "__main__":
 
     config["mode"] = cli_options["mode"]
     config["filename"] = cli_options.get("filename")
+    config["output"] = cli_options.get("output")
+    config["filenames"] = cli_options.get("filenames")
+    config["resume"] = cli_options.get("resume", False)
+    config["manifest"] = cli_options.get("manifest")
 
     logger = logging.getLogger("paperlessngx_postprocessor")
     logger.setLevel(config["verbose"])
@@ -63,22 +76,66 @@ if __name__ == "__main__":
         logger.critical("Can't restore and do a backup simultaneously. Please choose one or the other.")
         sys.exit(1)
 
-    if config["dry_run"]:
+    if config["shard"] is not None:
+        if not isinstance(config["shard"], tuple):
+            logger.critical(f"Invalid shard '{config['shard']}'. It must be of the form I/N, where 0 <= I < N.")
+            sys.exit(1)
+        if config["backup"] is not None:
+            # Each shard writes its own backup file, so they don't clobber each other. Use merge-backups to combine them afterwards.
+            config["backup"] = f"{config['backup']}.shard-{config['shard'][0]}-of-{config['shard'][1]}"
+
+    if config["mode"] == "merge-backups":
+        merged_documents = []
+        for filename in config["filenames"]:
+            with open(filename, "r") as backup_file:
+                yaml_documents = list(yaml.safe_load_all(backup_file))
+                logger.info(f"Read {len(yaml_documents)} documents from {filename}")
+                merged_documents.extend(yaml_documents)
+        with open(config["output"], "w") as backup_file:
+            backup_file.write(yaml.dump_all(merged_documents))
+        logger.info(f"Wrote {len(merged_documents)} documents to {config['output']}")
+        sys.exit(0)
+
+    if config["manifest"] is not None:
+        if config["mode"] == "restore" or config["backup"] is not None:
+            logger.critical("Can't restore or back up when working offline on an export, since nothing is changed in Paperless-ngx.")
+            sys.exit(1)
+        # Changes only ever go to the in-memory copy of the export, and that's how we find out what they would be
+        config["dry_run"] = False
+
+    if config["dry_run"] or config["manifest"] is not None:
         # Force at least info level, by choosing whichever level is lower, the given level or info (since more verbose is lower)
         logger.setLevel(min(logging.getLevelName(config["verbose"]), logging.getLevelName("INFO")))
-        logger.info("Doing a dry run. No changes will be made.")
+        if config["dry_run"]:
+            logger.info("Doing a dry run. No changes will be made.")
+        else:
+            logger.info(f"Working offline on {config['manifest']}. No changes will be made to Paperless-ngx.")
 
-    api = PaperlessAPI(config["paperless_api_url"],
-                       auth_token = config["auth_token"],
-                       paperless_src_dir = config["paperless_src_dir"],
-                       logger=logger)
+    if config["manifest"] is not None:
+        try:
+            api = OfflinePaperlessAPI(config["manifest"], logger=logger)
+        except (OSError, ValueError, PaperlessAPIError) as e:
+            logger.critical(f"Unable to load the export manifest {config['manifest']}: {e}")
+            sys.exit(1)
+    else:
+        api = PaperlessAPI(config["paperless_api_url"],
+                           auth_token = config["auth_token"],
+                           paperless_src_dir = config["paperless_src_dir"],
+                           cache_dir = config["cache_dir"],
+                           max_concurrency = config["max_concurrency"],
+                           max_retries = config["max_retries"],
+                           local_mirror = config["local_mirror"],
+                           response_cache_size = config["response_cache_size"],
+                           logger=logger)
     postprocessor = Postprocessor(api,
                                   config["rulesets_dir"],                                  
                                   postprocessing_tag = config["postprocessing_tag"],
                                   invalid_tag = config["invalid_tag"],
                                   dry_run = config["dry_run"],
                                   skip_validation = config["skip_validation"],
-                                  logger=logger)
+                                  logger=logger,
+                                  cache_dir = config["cache_dir"],
+                                  log_every = config["log_every"])
     
     documents = []
     if config["mode"] == "restore":
@@ -97,16 +154,46 @@ if __name__ == "__main__":
                     api.patch_document(document_id, yaml_document)
         sys.exit(0)
     elif config["mode"] == "process":
-        if selector_config["all"]:
-            documents = api.get_all_documents()
-            logger.info(f"Postprocessing all {len(documents)} documents")
-        elif not(any(selector_config.values())):
-            logger.error("No SELECTORS provided. Please specify at least one SELECTOR.")
+        # Documents are listed without their content, which is only fetched for the documents a matching rule's metadata_regex needs it for
+        document_fields = PaperlessAPI.metadata_fields
+        try:
+            # A document ID overrides any other selectors
+            if selector_config.get("document_id"):
+                if config["shard"] is None or int(selector_config.get("document_id")) % config["shard"][1] == config["shard"][0]:
+                    documents.append(api.get_document_by_id(selector_config.get("document_id")))
+            elif selector_config["all"]:
+                documents = api.get_all_documents(shard=config["shard"], document_fields=document_fields)
+                logger.info(f"Postprocessing all {len(documents)} documents")
+            elif not(any(selector_config.values())):
+                logger.error("No SELECTORS provided. Please specify at least one SELECTOR.")
+                sys.exit(1)
+            elif selector_config.get("rule"):
+                rule_name = selector_config.get("rule")
+                if postprocessor.get_rule(rule_name) is None:
+                    logger.error(f"No rule named '{rule_name}' found in {config['rulesets_dir']}")
+                    sys.exit(1)
+                rule_fields = postprocessor.get_rule(rule_name).get_query_fields()
+                if rule_fields is None:
+                    logger.warning(f"Rule '{rule_name}' never matches any documents")
+                    documents = []
+                else:
+                    # Any other selectors given on the command line narrow things down further
+                    # ("all" is always there, and False, since it was checked above)
+                    fields = {**rule_fields, **{key: value for key, value in selector_config.options().items() if value is not None and value is not False and key not in ("rule", "all")}}
+                    logger.debug(f"Selecting candidate documents for rule '{rule_name}' with {fields}")
+                    if api.field_names_query(**fields) is not None:
+                        documents = api.get_documents_by_field_names(shard=config["shard"], document_fields=document_fields, **fields)
+                    else:
+                        logger.warning(f"Couldn't translate the match template of rule '{rule_name}' into a query, so checking all documents")
+                        documents = api.get_all_documents(shard=config["shard"], document_fields=document_fields)
+                    num_candidates = len(documents)
+                    documents = postprocessor.filter_documents_by_rule(rule_name, documents)
+                    logger.info(f"Rule '{rule_name}' matches {len(documents)} of {num_candidates} candidate documents")
+            else:
+                documents = api.get_documents_by_field_names(shard=config["shard"], document_fields=document_fields, **selector_config.options())
+        except PaperlessAPIError as e:
+            logger.critical(f"Unable to get the documents to process: {e}")
             sys.exit(1)
-        elif selector_config.get("document_id"):
-            documents.append(api.get_document_by_id(selector_config.get("document_id")))
-        else:
-            documents = api.get_documents_by_field_names(**selector_config.options())
 
         # Filter out any null documents, and then warn if no documents are left
         documents = list(filter(lambda doc: doc, documents))
@@ -131,11 +218,77 @@ if __name__ == "__main__":
         #     # else:
         #     #     logger.info(f"Postprocessing {len(documents)} documents with {config['selector']} \'{config['item_id_or_name']}\'")
 
-        backup_documents = postprocessor.postprocess(documents)
+        # Keep track of which documents are done, so an interrupted run can be picked up where it left off with --resume
+        journal = RunJournal(config["cache_dir"], {"paperless_api_url": config["paperless_api_url"],
+                                                   "manifest": config["manifest"],
+                                                   "rulesets_dir": config["rulesets_dir"],
+                                                   "selectors": selector_config.options(),
+                                                   "shard": config["shard"],
+                                                   "dry_run": config["dry_run"],
+                                                   "rules_fingerprint": postprocessor.rules_fingerprint()})
+        num_already_done = 0
+        resuming = False
+        if config["resume"]:
+            previous_run = journal.load()
+            if previous_run is None:
+                logger.warning("No interrupted run with these selectors found, so starting from the beginning")
+            else:
+                run_info, finished = previous_run
+                if run_info.get("rules_fingerprint") != postprocessor.rules_fingerprint():
+                    logger.critical("The rules have changed since the interrupted run started, so it can't be resumed. Run again without --resume to start over.")
+                    sys.exit(1)
+                num_total = len(documents)
+                documents = [document for document in documents if document["id"] not in finished]
+                num_already_done = num_total - len(documents)
+                resuming = True
+                logger.info(f"Resuming an interrupted run, skipping {num_already_done} documents it already processed")
+                if len(documents) == 0:
+                    logger.info("All documents were already processed")
+                    journal.finish()
+                    sys.exit(0)
+        try:
+            journal.start(resume=resuming)
+        except OSError as e:
+            logger.warning(f"Unable to write the run journal {journal.path}, so this run can't be resumed if it's interrupted: {e}")
+            journal = None
+        progress = RunProgress(len(documents), logger, already_done=num_already_done)
+
+        backup_file = None
+        def on_document_done(document, document_backup_documents):
+            nonlocal backup_file
+            if len(document_backup_documents) > 0 and config["backup"] is not None:
+                if backup_file is None:
+                    logger.debug(f"Writing backup to {config['backup']}")
+                    # When resuming, the backups of the documents the interrupted run already changed are still needed
+                    backup_file = open(config["backup"], "a" if resuming else "w")
+                # Write the backup as we go, so it's complete even if the run gets interrupted
+                backup_file.write(yaml.dump_all(document_backup_documents, explicit_start=True))
+                backup_file.flush()
+            if journal is not None:
+                journal.record(document["id"])
+            progress.update()
+
+        try:
+            backup_documents = postprocessor.postprocess(documents, on_document_done=on_document_done)
+        finally:
+            if journal is not None:
+                journal.close()
+            if backup_file is not None:
+                backup_file.close()
+        if journal is not None:
+            journal.finish()
 
         logger.info(f"Changed {len(backup_documents)} out of {len(documents)} documents")
 
-        if len(backup_documents) > 0 and config["backup"] is not None:
-            logger.debug(f"Writing backup to {config['backup']}")
-            with open(config["backup"], "w") as backup_file:
-                backup_file.write(yaml.dump_all(backup_documents))
+        if config["manifest"] is not None:
+            logger.info(f"The rules would change {len(set(document_id for (document_id, _) in api.patches))} out of {len(documents)} documents")
+            for rule_name, statistics in postprocessor.rule_statistics().items():
+                logger.info(f" Rule '{rule_name}': matched {statistics['matched']}, didn't match {statistics['not_matched']}, failed validation {statistics['invalid']}, regex skipped by the prefilter {statistics['regex_skipped']}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (PaperlessAPIError, requests.RequestException) as e:
+        # Anything that goes wrong talking to Paperless-ngx (after retrying) ends the run, but doesn't need a traceback
+        logging.getLogger("paperlessngx_postprocessor").critical(f"Unable to talk to Paperless-ngx: {e}")
+        sys.exit(1)
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 
-from .paperless_api import PaperlessAPI
+from .paperless_api import PaperlessAPI, PaperlessAPIError, DeadlineExceeded
+from .offline_api import OfflinePaperlessAPI
 from .postprocessor import Postprocessor
 from .config import Config
+from .document_metadata import DocumentMetadata
@@ -0,0 +1,35 @@
+import hashlib
+import os
+from pathlib import Path
+
+class AuthTokenCache:
+    '''Stores automagically acquired auth tokens on disk, one file per API URL, readable only by the owner'''
+    def __init__(self, cache_dir):
+        self._cache_dir = Path(cache_dir) / "auth_tokens"
+
+    def _path_for(self, api_url):
+        # We key the file by a hash of the URL so we don't have to worry about characters that aren't allowed in filenames
+        return self._cache_dir / hashlib.sha256(api_url.encode("utf-8")).hexdigest()
+
+    def load(self, api_url):
+        try:
+            token = self._path_for(api_url).read_text().strip()
+        except OSError:
+            return None
+        return token if len(token) > 0 else None
+
+    def save(self, api_url, auth_token):
+        self._cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        path = self._path_for(api_url)
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        # Create the file with mode 0600 from the start, so the token is never readable by anyone else, even briefly
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as token_file:
+            token_file.write(auth_token)
+        os.replace(temp_path, path)
+
+    def clear(self, api_url):
+        try:
+            self._path_for(api_url).unlink()
+        except FileNotFoundError:
+            pass
@@ -16,7 +16,7 @@ class Config:
 
     def selector_options():
         return {"document_id": Config.OptionSpec(None, {"metavar": "DOCUMENT_ID",
-                                                        "help": "Select a document by its DOCUMENT_ID"}),
+                                                        "help": "Select a document by its DOCUMENT_ID. Overrides any other selectors."}),
                 "correspondent": Config.OptionSpec(None, {"metavar": "CORRESPONDENT_NAME",
                                                           "type": str,
                                                           "help": "Select documents by their CORRESPONDENT_NAME"}),
@@ -59,6 +59,9 @@ class Config:
                 "title": Config.OptionSpec(None, {"metavar": "TITLE",
                                                 "type": str,
                                                 "help": "Select document by its TITLE"}),
+                "rule": Config.OptionSpec(None, {"metavar": "RULE_NAME",
+                                                 "type": str,
+                                                 "help": "Select the documents the rule named RULE_NAME applies to. The simple conditions in its match template (e.g. correspondent == 'The Bank', or 'Some Tag' in tag_list) are used to ask Paperless-ngx for only the candidate documents, and then the full template is checked for each of them."}),
                 "all": Config.OptionSpec(False, {"action": "store_true",
                                                  "help": "Select all documents. WARNING! If you have a lot of documents, this will take a long time."}),
         }
@@ -96,6 +99,45 @@ class Config:
                 "paperless_src_dir": Config.OptionSpec("/usr/src/paperless/src", {"metavar": "PAPERLESS_SRC_DIR",
                                                                                   "type": str,
                                                                                   "help": "The directory containing the source for the running instance of paperless. If this is set incorrectly, postprocessor will not be able to automagically acquire the AUTH_TOKEN. (default: {default})"}),
+                "shard": Config.OptionSpec(None, {"metavar": "I/N",
+                                                  "type": str,
+                                                  "help": "Only process shard I of N (counting from 0), i.e. the documents whose ID modulo N is I. This lets several instances process disjoint parts of a large selection in parallel. If a backup is being made, '.shard-I-of-N' is appended to its filename."}),
+                "max_concurrency": Config.OptionSpec(4, {"metavar": "N",
+                                                         "type": int,
+                                                         "help": "The most requests to make to the Paperless-ngx REST API at once. Fewer are made if the server looks overloaded. (default: {default})"}),
+                "max_retries": Config.OptionSpec(5, {"metavar": "N",
+                                                     "type": int,
+                                                     "help": "How many times to retry a request that failed because the Paperless-ngx server was unreachable or overloaded. (default: {default})"}),
+                "log_every": Config.OptionSpec(1, {"metavar": "N",
+                                                   "type": int,
+                                                   "help": "Only log the per-document INFO messages (like which changes were made) for one in every N documents, to keep the logs of big runs manageable. Warnings and errors are always logged. (default: {default})"}),
+                "local_mirror": Config.OptionSpec(False, {"action": "store_const",
+                                                          "const": True,
+                                                          "help": "Keep a local copy of the metadata of all documents in CACHE_DIR, which is synced incrementally, and use it to select documents and for num_documents(). (default: {default})"}),
+                "response_cache_size": Config.OptionSpec(256, {"metavar": "N",
+                                                               "type": int,
+                                                               "help": "How many responses for single documents (without their content) and their metadata to keep in memory, so asking for them again only costs a conditional request, or none at all. 0 turns the cache off. (default: {default})"}),
+                "cache_dir": Config.OptionSpec(str(Path(__file__).resolve().parent.parent / "cache"), {"metavar": "CACHE_DIR",
+                                                                                                       "type": str,
+                                                                                                       "help": "The directory where postprocessor caches things between runs, like an automagically acquired AUTH_TOKEN. (default: {default})"}),
+                "spool_dir": Config.OptionSpec(str(Path(__file__).resolve().parent.parent / "spool"), {"metavar": "SPOOL_DIR",
+                                                                                                       "type": str,
+                                                                                                       "help": "The directory where postprocessor keeps queues of work to be done in the background, like documents waiting for their OCR to be repaired. (default: {default})"}),
+                "ocr_repair_workers": Config.OptionSpec(1, {"metavar": "N",
+                                                            "type": int,
+                                                            "help": "How many documents post_consume_cid_fixer.py repairs at once in the background. (default: {default})"}),
+                "ocr_repair_jobs_per_core": Config.OptionSpec(1.0, {"metavar": "JOBS",
+                                                                    "type": float,
+                                                                    "help": "How many OCR jobs to run per CPU core, split between all of the documents being repaired at once. (default: {default})"}),
+                "time_budget": Config.OptionSpec(None, {"metavar": "SECONDS",
+                                                        "type": float,
+                                                        "help": "The most time the post-consume hook may spend postprocessing a document. If Paperless-ngx is too slow to answer in time, the document is postprocessed in the background later instead. (default: no limit)"}),
+                "detach_post_consume_script": Config.OptionSpec(False, {"action": "store_const",
+                                                                        "const": True,
+                                                                        "help": "Queue the user's post-consume script to be run in the background (and retried if it fails), instead of making Paperless-ngx wait for it. (default: {default})"}),
+                "post_consume_script_workers": Config.OptionSpec(1, {"metavar": "N",
+                                                                     "type": int,
+                                                                     "help": "How many queued post-consume scripts to run at once in the background. (default: {default})"}),
         }
 
     def __init__(self, options_spec, use_environment_variables = True):
@@ -150,11 +192,12 @@ class Config:
         # This is how it's checked in paperless-ngx, see https://github.com/paperless-ngx/paperless-ngx/blob/246f17c6c85ee0d4958e5c6e99f77007a050839c/src/paperless/settings.py#L42
         if bool(os.environ.get("PAPERLESS_DEBUG", "NO").lower() in ("yes", "y", "1", "t", "true")):
             self._options["verbose"] = "DEBUG"
-        if isinstance(self._options.get("dry_run"), str):
-            if self._options["dry_run"].lower() in ["f", "false", "no"]:
-                self._options["dry_run"] = False
-            elif self._options["dry_run"].lower() in ["t", "true", "yes"]:
-                self._options["dry_run"] = True
+        for option_name in ["dry_run", "local_mirror", "detach_post_consume_script"]:
+            if isinstance(self._options.get(option_name), str):
+                if self._options[option_name].lower() in ["f", "false", "no"]:
+                    self._options[option_name] = False
+                elif self._options[option_name].lower() in ["t", "true", "yes"]:
+                    self._options[option_name] = True
         if isinstance(self._options.get("backup"), str):
             if self._options["backup"].lower() == "default":
                 self._options["backup"] = Config._default_backup_name
@@ -162,6 +205,19 @@ class Config:
                 backup_path = Path(self._options["backup"])
                 if backup_path.is_dir():
                     self._options["backup"] = str(backup_path / Path(Config._default_backup_name))
+        for option_name in ["max_concurrency", "max_retries", "log_every", "response_cache_size", "ocr_repair_workers", "post_consume_script_workers"]:
+            if isinstance(self._options.get(option_name), str):
+                self._options[option_name] = int(self._options[option_name])
+        for option_name in ["ocr_repair_jobs_per_core", "time_budget"]:
+            if isinstance(self._options.get(option_name), str):
+                self._options[option_name] = float(self._options[option_name])
+        if isinstance(self._options.get("shard"), str):
+            # If the shard can't be parsed we leave it as a string, so whoever uses it can complain
+            parts = self._options["shard"].split("/")
+            if len(parts) == 2 and parts[0].strip().isdigit() and parts[1].strip().isdigit():
+                shard_index, num_shards = int(parts[0]), int(parts[1])
+                if num_shards > 0 and shard_index < num_shards:
+                    self._options["shard"] = (shard_index, num_shards)
         if isinstance(self._options.get("created_range"), str):
             dates = self._options.get("created_range").split("--")
             if len(dates) == 2:
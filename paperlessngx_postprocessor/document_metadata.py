@@ -0,0 +1,143 @@
+import collections.abc
+import dateutil.parser
+import sys
+
+class _DocumentFields:
+    '''The metadata of a document as it came from paperless-ngx. Shared (and never changed) by every DocumentMetadata made from it.'''
+    __slots__ = ("document_id", "correspondent", "document_type", "storage_path", "asn", "tag_list", "title",
+                 "created", "added", "_created_date_object", "_added_date_object", "_derived")
+
+    def __init__(self, document_id, correspondent, document_type, storage_path, asn, tag_list, title, created, added):
+        self.document_id = document_id
+        # Names are interned, since the same handful of correspondents, types, etc. show up on most documents
+        self.correspondent = _intern(correspondent)
+        self.document_type = _intern(document_type)
+        self.storage_path = _intern(storage_path)
+        self.asn = asn
+        self.tag_list = [_intern(tag) for tag in tag_list]
+        self.title = title
+        self.created = created
+        self.added = added
+        self._created_date_object = None
+        self._added_date_object = None
+        self._derived = None
+
+    def created_date_object(self):
+        if self._created_date_object is None:
+            self._created_date_object = dateutil.parser.isoparse(self.created)
+        return self._created_date_object
+
+    def added_date_object(self):
+        if self._added_date_object is None:
+            self._added_date_object = dateutil.parser.isoparse(self.added)
+        return self._added_date_object
+
+    def derived(self, key):
+        # The year/month/day strings are only worked out the first time any of them is asked for
+        if self._derived is None:
+            created_date = self.created_date_object()
+            added_date = self.added_date_object()
+            self._derived = {"created_year": f"{created_date.year:04d}",
+                             "created_month": f"{created_date.month:02d}",
+                             "created_day": f"{created_date.day:02d}",
+                             "created_date": created_date.strftime("%F"), # %F means YYYY-MM-DD
+                             "added_year": f"{added_date.year:04d}",
+                             "added_month": f"{added_date.month:02d}",
+                             "added_day": f"{added_date.day:02d}",
+                             "added_date": added_date.strftime("%F")}
+        return self._derived[key]
+
+def _intern(name):
+    return sys.intern(name) if type(name) is str else name
+
+_getters = {"document_id": lambda fields: fields.document_id,
+            "correspondent": lambda fields: fields.correspondent,
+            "document_type": lambda fields: fields.document_type,
+            "storage_path": lambda fields: fields.storage_path,
+            "asn": lambda fields: fields.asn,
+            "tag_list": lambda fields: fields.tag_list,
+            "title": lambda fields: fields.title,
+            "created": lambda fields: fields.created,
+            "created_year": lambda fields: fields.derived("created_year"),
+            "created_month": lambda fields: fields.derived("created_month"),
+            "created_day": lambda fields: fields.derived("created_day"),
+            "created_date": lambda fields: fields.derived("created_date"),
+            "created_date_object": lambda fields: fields.created_date_object(),
+            "added": lambda fields: fields.added,
+            "added_year": lambda fields: fields.derived("added_year"),
+            "added_month": lambda fields: fields.derived("added_month"),
+            "added_day": lambda fields: fields.derived("added_day"),
+            "added_date": lambda fields: fields.derived("added_date"),
+            "added_date_object": lambda fields: fields.added_date_object(),
+}
+
+_deleted = object()
+
+class DocumentMetadata(collections.abc.MutableMapping):
+    '''A document's metadata in "filename format", e.g. as passed to the rules' jinja templates.
+
+    This behaves like a dict, but the values that came from paperless-ngx live in a compact shared
+    record, and any changes (e.g. from rules) are kept in a small overlay on top of it. So copying
+    it only copies the changes, not all of the metadata.'''
+    __slots__ = ("_fields", "_overrides")
+
+    def __init__(self, fields, overrides=None):
+        self._fields = fields
+        self._overrides = overrides if overrides is not None else {}
+
+    @classmethod
+    def from_document(cls, document, correspondent, document_type, storage_path, tag_list):
+        return cls(_DocumentFields(document["id"], correspondent, document_type, storage_path,
+                                   document["archive_serial_number"], tag_list, document["title"],
+                                   document["created"], document["added"]))
+
+    def __getitem__(self, key):
+        value = self._overrides.get(key, _deleted)
+        if value is not _deleted:
+            return value
+        if key in self._overrides or key not in _getters:
+            raise KeyError(key)
+        return _getters[key](self._fields)
+
+    def __setitem__(self, key, value):
+        self._overrides[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in _getters:
+            self._overrides[key] = _deleted
+        else:
+            del self._overrides[key]
+
+    def __contains__(self, key):
+        value = self._overrides.get(key)
+        if value is _deleted:
+            return False
+        return value is not None or key in self._overrides or key in _getters
+
+    def __iter__(self):
+        for key in _getters:
+            if self._overrides.get(key) is not _deleted:
+                yield key
+        for key, value in self._overrides.items():
+            if key not in _getters:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return DocumentMetadata(self._fields, self._overrides.copy())
+
+    def overlay(self, changes):
+        '''Returns a new DocumentMetadata with the given changes applied on top of this one'''
+        overrides = self._overrides.copy()
+        if isinstance(changes, DocumentMetadata) and changes._fields is self._fields:
+            overrides.update(changes._overrides)
+        else:
+            overrides.update(changes)
+        return DocumentMetadata(self._fields, overrides)
@@ -0,0 +1,137 @@
+import dateutil.parser
+import sqlite3
+from datetime import date
+from pathlib import Path
+
+class LocalMirror:
+    '''A local sqlite copy of the metadata (but not the content) of every document, and of the correspondents, document types, storage paths and tags.
+
+    It's kept up to date incrementally by PaperlessAPI, which only asks paperless-ngx for the
+    documents modified since the last sync. Selecting documents by their fields (e.g. for
+    num_documents()) can then be answered with an indexed query instead of by paging through the
+    matching documents on the server.'''
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self._path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # Several hooks may sync at the same time, so wait for each other rather than failing
+        self._connection = sqlite3.connect(str(self._path), timeout=30, check_same_thread=False)
+        with self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, correspondent INTEGER, document_type INTEGER, storage_path INTEGER,
+                                                      archive_serial_number INTEGER, title_lower TEXT, modified TEXT,
+                                                      created_date TEXT, created_year INTEGER, created_month INTEGER, created_day INTEGER,
+                                                      added_date TEXT, added_year INTEGER, added_month INTEGER, added_day INTEGER);
+                CREATE INDEX IF NOT EXISTS documents_correspondent ON documents (correspondent);
+                CREATE INDEX IF NOT EXISTS documents_document_type ON documents (document_type);
+                CREATE INDEX IF NOT EXISTS documents_storage_path ON documents (storage_path);
+                CREATE INDEX IF NOT EXISTS documents_asn ON documents (archive_serial_number);
+                CREATE INDEX IF NOT EXISTS documents_title ON documents (title_lower);
+                CREATE INDEX IF NOT EXISTS documents_created ON documents (created_date);
+                CREATE INDEX IF NOT EXISTS documents_created_parts ON documents (created_year, created_month, created_day);
+                CREATE INDEX IF NOT EXISTS documents_added ON documents (added_date);
+                CREATE INDEX IF NOT EXISTS documents_added_parts ON documents (added_year, added_month, added_day);
+                CREATE TABLE IF NOT EXISTS document_tags (document_id INTEGER, tag_id INTEGER, PRIMARY KEY (document_id, tag_id));
+                CREATE INDEX IF NOT EXISTS document_tags_tag ON document_tags (tag_id);
+                CREATE TABLE IF NOT EXISTS items (item_type TEXT, id INTEGER, name_lower TEXT, PRIMARY KEY (item_type, id));
+                CREATE INDEX IF NOT EXISTS items_name ON items (item_type, name_lower);
+                CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);
+            ''')
+
+    def get_last_modified(self):
+        '''The latest modification time of any document synced so far, or None if nothing has been synced yet'''
+        row = self._connection.execute("SELECT value FROM sync_state WHERE key = 'last_modified'").fetchone()
+        return row[0] if row is not None else None
+
+    def replace_items(self, item_type, items):
+        with self._connection:
+            self._connection.execute("DELETE FROM items WHERE item_type = ?", (item_type,))
+            self._connection.executemany("INSERT INTO items (item_type, id, name_lower) VALUES (?, ?, ?)",
+                                         [(item_type, item["id"], str(item.get("name")).lower()) for item in items])
+
+    def upsert_documents(self, documents, synced=True):
+        '''Adds or updates the given documents (as returned by the REST API). If synced, they're the result of a sync, so the latest modification time among them is remembered for the next sync.'''
+        last_modified = self.get_last_modified()
+        rows = []
+        for document in documents:
+            created_date = document.get("created_date") or str(document["created"])[:10]
+            added_date = str(document["added"])[:10]
+            created = date.fromisoformat(created_date)
+            added = date.fromisoformat(added_date)
+            rows.append((document["id"], document.get("correspondent"), document.get("document_type"), document.get("storage_path"),
+                         document.get("archive_serial_number"), str(document.get("title")).lower(), document.get("modified"),
+                         created_date, created.year, created.month, created.day,
+                         added_date, added.year, added.month, added.day))
+            modified = document.get("modified")
+            # Compare the times themselves rather than the strings, in case they're in different timezones
+            if modified is not None and (last_modified is None or dateutil.parser.isoparse(modified) > dateutil.parser.isoparse(last_modified)):
+                last_modified = modified
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._connection.executemany("DELETE FROM document_tags WHERE document_id = ?", [(document["id"],) for document in documents])
+            self._connection.executemany("INSERT OR IGNORE INTO document_tags (document_id, tag_id) VALUES (?, ?)",
+                                         [(document["id"], tag_id) for document in documents for tag_id in document.get("tags", [])])
+            if synced and last_modified is not None:
+                self._connection.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('last_modified', ?)", (last_modified,))
+
+    def remove_documents_except(self, document_ids):
+        '''Removes every document that's not in document_ids, i.e. that was deleted in paperless-ngx'''
+        document_ids = set(document_ids)
+        stale_ids = [(document_id,) for (document_id,) in self._connection.execute("SELECT id FROM documents") if document_id not in document_ids]
+        if len(stale_ids) > 0:
+            with self._connection:
+                self._connection.executemany("DELETE FROM documents WHERE id = ?", stale_ids)
+                self._connection.executemany("DELETE FROM document_tags WHERE document_id = ?", stale_ids)
+        return len(stale_ids)
+
+    def _where(self, fields):
+        '''Translates the same fields as PaperlessAPI.get_documents_by_field_names() into a where clause. Returns (clause, parameters), or None if there are no fields.'''
+        conditions = []
+        parameters = []
+        for field, item_type in [("correspondent", "correspondents"), ("document_type", "document_types"), ("storage_path", "storage_paths")]:
+            if fields.get(field) is not None:
+                conditions.append(f"{field} IN (SELECT id FROM items WHERE item_type = ? AND name_lower = ?)")
+                parameters.extend([item_type, str(fields[field]).lower()])
+        if fields.get("tag") is not None:
+            conditions.append("id IN (SELECT document_id FROM document_tags WHERE tag_id IN (SELECT id FROM items WHERE item_type = 'tags' AND name_lower = ?))")
+            parameters.append(str(fields["tag"]).lower())
+        for field in ["created_year", "created_month", "created_day", "added_year", "added_month", "added_day"]:
+            if fields.get(field) is not None:
+                conditions.append(f"{field} = ?")
+                parameters.append(int(fields[field]))
+        if fields.get("asn") is not None:
+            conditions.append("archive_serial_number = ?")
+            parameters.append(int(fields["asn"]))
+        if fields.get("title") is not None:
+            conditions.append("title_lower = ?")
+            parameters.append(str(fields["title"]).lower())
+        for field in ["created", "added"]:
+            date_range = fields.get(f"{field}_range")
+            if isinstance(date_range, (tuple, list)) and len(date_range) == 2:
+                if isinstance(date_range[0], date):
+                    conditions.append(f"{field}_date > ?")
+                    parameters.append(date_range[0].strftime("%F"))
+                if isinstance(date_range[1], date):
+                    conditions.append(f"{field}_date < ?")
+                    parameters.append(date_range[1].strftime("%F"))
+            if isinstance(fields.get(f"{field}_date_object"), date):
+                conditions.append(f"{field}_date = ?")
+                parameters.append(fields[f"{field}_date_object"].strftime("%F"))
+        if len(conditions) == 0:
+            return None
+        return " AND ".join(conditions), parameters
+
+    def get_document_ids(self, **fields):
+        where = self._where(fields)
+        if where is None:
+            return None
+        return [document_id for (document_id,) in self._connection.execute(f"SELECT id FROM documents WHERE {where[0]} ORDER BY id", where[1])]
+
+    def count_documents(self, **fields):
+        where = self._where(fields)
+        if where is None:
+            return None
+        return self._connection.execute(f"SELECT COUNT(*) FROM documents WHERE {where[0]}", where[1]).fetchone()[0]
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,224 @@
+import bisect
+import json
+import urllib.parse
+from datetime import date
+from pathlib import Path
+
+from .paperless_api import PaperlessAPI, PaperlessAPIError
+
+class OfflineResponse:
+    '''Stands in for a requests.Response to a PATCH, for code that checks response.ok and response.json()'''
+    def __init__(self, document):
+        self.ok = True
+        self.status_code = 200
+        self._document = document
+
+    def json(self):
+        return dict(self._document)
+
+class OfflinePaperlessAPI(PaperlessAPI):
+    '''A PaperlessAPI that works on a Paperless-ngx export instead of a live server.
+
+    The manifest written by Paperless-ngx's document_exporter (either a single manifest.json, or
+    the per-document manifests written with --split-manifest) is loaded into memory, and indexed
+    so selecting documents (e.g. for num_documents()) doesn't have to look at all of them. Changes
+    made by patch_document() only change the in-memory copy, and are recorded in patches, so rules
+    can be tried out on a whole archive without ever touching the server.'''
+
+    # Which manifest model each of the API's item types comes from
+    _models = {"documents.correspondent": "correspondents",
+               "documents.documenttype": "document_types",
+               "documents.storagepath": "storage_paths",
+               "documents.tag": "tags"}
+
+    def __init__(self, manifest_path, logger=None):
+        # Everything that talks to the server is overridden, so the token is never used; and nothing is
+        # ever fetched, so there's nothing to cache
+        super().__init__(f"offline:{manifest_path}",
+                         auth_token="offline",
+                         paperless_src_dir=None,
+                         logger=logger,
+                         response_cache_size=0)
+        self.patches = []
+
+        self._items = {item_type: {} for item_type in self._cachable_types}
+        self._documents = {}
+        for manifest_filename in self._manifest_filenames(Path(manifest_path)):
+            self._logger.debug(f"Loading {manifest_filename}")
+            with open(manifest_filename, "r") as manifest_file:
+                self._load_records(json.load(manifest_file))
+        self._build_indexes()
+        self._logger.info(f"Loaded {len(self._documents)} documents from {manifest_path}")
+
+    def _manifest_filenames(self, manifest_path):
+        if manifest_path.is_file():
+            return [manifest_path]
+        filenames = []
+        if (manifest_path / "manifest.json").is_file():
+            filenames.append(manifest_path / "manifest.json")
+        # With --split-manifest, each document's record is in its own -manifest.json file next to it
+        filenames.extend(sorted(manifest_path.rglob("*-manifest.json")))
+        if len(filenames) == 0:
+            raise PaperlessAPIError(f"No Paperless-ngx export manifest found at {manifest_path}")
+        return filenames
+
+    def _load_records(self, records):
+        for record in records:
+            model = record.get("model")
+            fields = record.get("fields", {})
+            if model in OfflinePaperlessAPI._models:
+                self._items[OfflinePaperlessAPI._models[model]][record["pk"]] = {"id": record["pk"], **fields}
+            elif model == "documents.document":
+                created = str(fields.get("created"))
+                self._documents[record["pk"]] = {"id": record["pk"],
+                                                 "correspondent": fields.get("correspondent"),
+                                                 "document_type": fields.get("document_type"),
+                                                 "storage_path": fields.get("storage_path"),
+                                                 "archive_serial_number": fields.get("archive_serial_number"),
+                                                 "tags": list(fields.get("tags", [])),
+                                                 "title": fields.get("title"),
+                                                 "content": fields.get("content", ""),
+                                                 "created": created,
+                                                 "created_date": created[:10],
+                                                 "modified": fields.get("modified"),
+                                                 "added": fields.get("added"),
+                                                 "original_file_name": fields.get("original_filename")}
+
+    def _build_indexes(self):
+        self._ids_by_name = {item_type: {} for item_type in self._cachable_types}
+        for item_type, items in self._items.items():
+            for item in items.values():
+                self._ids_by_name[item_type].setdefault(str(item.get("name")).lower(), []).append(item["id"])
+
+        # Maps each filter (e.g. "correspondent__id") to its value, to the set of IDs of the documents with that value
+        self._index = {}
+        # Date ranges are looked up by bisecting these sorted lists of (date, document ID), which are only resorted when needed
+        self._dates = {"created": {}, "added": {}}
+        self._sorted_dates = None
+        for document in self._documents.values():
+            self._index_document(document)
+
+    def _index_keys(self, document):
+        created = date.fromisoformat(str(document["created"])[:10])
+        added = date.fromisoformat(str(document["added"])[:10])
+        keys = [("correspondent__id", document["correspondent"]),
+                ("document_type__id", document["document_type"]),
+                ("storage_path__id", document["storage_path"]),
+                ("archive_serial_number", str(document["archive_serial_number"])),
+                ("title__iexact", str(document["title"]).lower()),
+                ("created__year", created.year),
+                ("created__month", created.month),
+                ("created__day", created.day),
+                ("added__year", added.year),
+                ("added__month", added.month),
+                ("added__day", added.day)]
+        keys.extend(("tags__id", tag_id) for tag_id in document["tags"])
+        return keys, created, added
+
+    def _index_document(self, document):
+        keys, created, added = self._index_keys(document)
+        for key, value in keys:
+            self._index.setdefault(key, {}).setdefault(value, set()).add(document["id"])
+        self._dates["created"][document["id"]] = created
+        self._dates["added"][document["id"]] = added
+        self._sorted_dates = None
+
+    def _unindex_document(self, document):
+        keys, _, _ = self._index_keys(document)
+        for key, value in keys:
+            self._index.get(key, {}).get(value, set()).discard(document["id"])
+
+    def _get_sorted_dates(self, field):
+        if self._sorted_dates is None:
+            self._sorted_dates = {name: sorted((document_date, document_id) for document_id, document_date in dates.items())
+                                  for name, dates in self._dates.items()}
+        return self._sorted_dates[field]
+
+    def _request(self, method, url, **kwargs):
+        # Anything that isn't handled offline would otherwise go to the network
+        raise PaperlessAPIError(f"Can't {method} {url} when working offline")
+
+    def _get_list(self, item_type, query=None):
+        if item_type == "documents":
+            return [dict(self._documents[document_id]) for document_id in sorted(self._select(query))]
+        items = list(self._items.get(item_type, {}).values())
+        if query is not None:
+            name = dict(urllib.parse.parse_qsl(query)).get("name__iexact")
+            if name is not None:
+                items = [item for item in items if str(item.get("name")).lower() == name.lower()]
+        elif item_type in self._cachable_types:
+            self._cache[item_type] = items
+        return items
+
+    def _select(self, query):
+        '''Returns the IDs of the documents matching the given (paperless-ngx REST API) query'''
+        selected = None
+        for key, value in urllib.parse.parse_qsl(query or ""):
+            if key in ["fields", "page_size", "page"]:
+                continue
+            matching = self._matching(key, value)
+            selected = matching if selected is None else selected & matching
+        return set(self._documents.keys()) if selected is None else selected
+
+    def _matching(self, key, value):
+        for item_type, field in [("correspondents", "correspondent"), ("document_types", "document_type"), ("storage_paths", "storage_path"), ("tags", "tags")]:
+            if key == f"{field}__name__iexact":
+                ids = self._ids_by_name[item_type].get(value.lower(), [])
+                return set().union(*[self._index.get(f"{field}__id", {}).get(item_id, set()) for item_id in ids])
+        if key == "id__in":
+            return {int(document_id) for document_id in value.split(",") if int(document_id) in self._documents}
+        if key == "title__iexact":
+            return set(self._index.get(key, {}).get(value.lower(), set()))
+        if key in ["created__date__gt", "created__date__lt", "added__date__gt", "added__date__lt"]:
+            dates = self._get_sorted_dates(key.split("__")[0])
+            boundary = date.fromisoformat(value)
+            if key.endswith("__gt"):
+                return {document_id for (_, document_id) in dates[bisect.bisect_right(dates, (boundary, float("inf"))):]}
+            return {document_id for (_, document_id) in dates[:bisect.bisect_left(dates, (boundary, float("-inf")))]}
+        if key in ["created__year", "created__month", "created__day", "added__year", "added__month", "added__day"]:
+            # Compared as numbers, like paperless-ngx does, so e.g. created__month=03 finds March
+            try:
+                return set(self._index.get(key, {}).get(int(value), set()))
+            except ValueError:
+                raise PaperlessAPIError(f"Invalid value '{value}' for {key}")
+        if key in self._index or key == "archive_serial_number":
+            return set(self._index.get(key, {}).get(value, set()))
+        raise PaperlessAPIError(f"Filtering documents by {key} isn't supported when working offline")
+
+    def _get_documents(self, query=None, shard=None, document_fields=None):
+        document_ids = sorted(self._select(query))
+        if shard is not None:
+            shard_index, num_shards = shard
+            document_ids = [document_id for document_id in document_ids if document_id % num_shards == shard_index]
+        return [dict(self._documents[document_id]) for document_id in document_ids]
+
+    def _count_documents(self, query):
+        return len(self._select(query))
+
+    def get_documents_by_ids(self, document_ids, batch_size=100, document_fields=None):
+        return [dict(self._documents[document_id]) for document_id in document_ids if document_id in self._documents]
+
+    def _get_item_by_id(self, item_type, item_id):
+        if not item_id:
+            return {}
+        items = self._documents if item_type == "documents" else self._items.get(item_type, {})
+        item = items.get(int(item_id))
+        return dict(item) if item is not None else {}
+
+    def get_document_content(self, document_id):
+        return self._documents.get(int(document_id), {}).get("content")
+
+    def patch_document(self, document_id, data):
+        document = self._documents[int(document_id)]
+        self.patches.append((document["id"], dict(data)))
+        self._unindex_document(document)
+        document.update({key: value for key, value in data.items() if key in document and key != "created_date"})
+        if "created_date" in data:
+            # Keep the time of day (and timezone) the document was created at, like paperless-ngx does
+            document["created"] = data["created_date"] + document["created"][10:]
+            document["created_date"] = data["created_date"]
+        self._index_document(document)
+        return OfflineResponse(document)
+
+    def delete_document_by_id(self, document_id):
+        raise PaperlessAPIError("Can't delete documents when working offline")
@@ -1,12 +1,44 @@
 import dateutil.parser
+import hashlib
+import json
 import logging
 import os
 import requests
+import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from pathlib import Path
 
+try:
+    # orjson is optional, but decodes big pages of documents (with their content) several times faster than the json module
+    import orjson as _fast_json
+except ImportError:
+    _fast_json = None
+
+from .auth_token_cache import AuthTokenCache
+from .document_metadata import DocumentMetadata
+from .local_mirror import LocalMirror
+from .request_controller import RequestController
+from .response_cache import ResponseCache
+
+class PaperlessAPIError(RuntimeError):
+    pass
+
+class DeadlineExceeded(PaperlessAPIError):
+    pass
+
 class PaperlessAPI:
-    def __init__(self, api_url, auth_token, paperless_src_dir, logger=None):
+    # Requests that are safe to send again if we don't know whether the first attempt got through
+    _idempotent_methods = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+    # Every field of a document that postprocessing needs, except its (potentially huge) content
+    metadata_fields = ["id", "correspondent", "document_type", "storage_path", "archive_serial_number", "tags",
+                       "title", "created", "created_date", "modified", "added", "original_file_name"]
+
+    def __init__(self, api_url, auth_token, paperless_src_dir, logger=None, cache_dir=None, max_concurrency=4, max_retries=5, local_mirror=False, response_cache_size=256):
         self._logger = logger
         if self._logger is None:
             logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", level="CRITICAL")
@@ -16,47 +48,196 @@ class PaperlessAPI:
             api_url = api_url[:-1]
 
         self._api_url = api_url
+        self._controller = RequestController(max_concurrency=max_concurrency, max_retries=max_retries)
+        # How many requests we've made, and how long we've spent waiting for them (including retries) in total
+        self._stats_lock = threading.Lock()
+        self.num_requests = 0
+        self.request_time = 0.0
+        # How many responses we've decoded, how many bytes they took on the wire and once uncompressed, and how long decoding them took
+        self.num_decoded = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.decode_time = 0.0
+        # If set (as a time.monotonic()), requests time out rather than run past it, see set_deadline()
+        self._deadline = None
+        self._paperless_src_dir = paperless_src_dir
+        self._auth_token_cache = AuthTokenCache(cache_dir) if cache_dir is not None else None
+        # We only try to reacquire the token on a 401 if we acquired it ourselves, never if it was explicitly given
+        self._auth_token_is_automagic = auth_token is None
         if auth_token is None:
-            logging.debug("No auth token specified, trying to acquire automagically...")
-            from .get_auth_token import get_auth_token
-            auth_token = get_auth_token(paperless_src_dir)
-            logging.debug(f"Auth token {auth_token} acquired")
+            auth_token = self._acquire_auth_token()
 
         self._auth_token = auth_token
+        # The local mirror is only opened (and synced) the first time it's needed
+        self._mirror = None
+        self._mirror_path = None
+        if local_mirror and cache_dir is not None:
+            self._mirror_path = Path(cache_dir) / "mirrors" / f"{hashlib.sha256(api_url.encode('utf-8')).hexdigest()}.sqlite3"
         self._cache = {}
+        self._cache_index = {}
         self._cachable_types = ["correspondents", "document_types", "storage_paths", "tags"]
+        # Single documents (without their content) and their metadata, which are often asked for more than once (e.g. by the post-consume hook)
+        self._response_cache = ResponseCache(response_cache_size)
         self._paperless_api_version = 3
 
         self._common_headers = {"Authorization": f"Token {self._auth_token}",
                                 "Accept": f"application/json; version={self._paperless_api_version}"}
 
+    def _acquire_auth_token(self, use_cache=True):
+        if use_cache and self._auth_token_cache is not None:
+            auth_token = self._auth_token_cache.load(self._api_url)
+            if auth_token is not None:
+                self._logger.debug("Using cached auth token")
+                return auth_token
+
+        self._logger.debug("No auth token specified, trying to acquire automagically...")
+        # This is imported here because importing django (and then setting it up) is slow, so we only want to do it when we really have to
+        from .get_auth_token import get_auth_token
+        auth_token = get_auth_token(self._paperless_src_dir)
+        self._logger.debug("Auth token acquired")
+
+        if self._auth_token_cache is not None:
+            try:
+                self._auth_token_cache.save(self._api_url, auth_token)
+            except OSError as e:
+                self._logger.warning(f"Unable to cache auth token: {e}")
+        return auth_token
+
+    def set_deadline(self, deadline):
+        '''Makes sure no request runs past deadline (a time.monotonic()), by giving each one a timeout of however much time is left, and raising DeadlineExceeded once there's none left. None removes the deadline.'''
+        self._deadline = deadline
+
+    def _remaining_time(self, method, url):
+        if self._deadline is None:
+            return None
+        remaining_time = self._deadline - time.monotonic()
+        if remaining_time <= 0:
+            raise DeadlineExceeded(f"Ran out of time before {method} {url}")
+        return remaining_time
+
+    def _send(self, method, url, headers=None, **kwargs):
+        headers = {**self._common_headers, **headers} if headers is not None else self._common_headers
+        attempt = 0
+        while True:
+            # requests applies the timeout to connecting and to each read rather than to the whole request, so a server trickling out a response could still take a little longer
+            timeout = self._remaining_time(method, url)
+            self._controller.acquire()
+            start_time = time.monotonic()
+            response = None
+            try:
+                response = requests.request(method, url, headers = headers, timeout = timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                overloaded = response is None or response.status_code in RequestController.overload_statuses
+                self._controller.release(time.monotonic() - start_time, overloaded)
+
+            if not overloaded:
+                return response
+            # A PATCH might have been applied even if we never saw the response, so only retry it if the server told us it was rejected
+            retryable = method in PaperlessAPI._idempotent_methods or (response is not None and response.status_code in [429, 503])
+            if not retryable or attempt >= self._controller.max_retries:
+                if response is None:
+                    raise error
+                return response
+            delay = self._controller.backoff(attempt, response.headers.get("Retry-After") if response is not None else None)
+            if self._deadline is not None and time.monotonic() + delay >= self._deadline:
+                raise DeadlineExceeded(f"{method} {url} failed ({error if response is None else response.status_code}), and there's no time left to retry it")
+            self._logger.info(f"{method} {url} failed ({error if response is None else response.status_code}), retrying in {delay:.1f}s (concurrency limit is now {self._controller.limit})")
+            time.sleep(delay)
+            attempt += 1
+
+    def _request(self, method, url, **kwargs):
+        start_time = time.monotonic()
+        try:
+            response = self._send(method, url, **kwargs)
+            if response.status_code == 401 and self._auth_token_is_automagic:
+                # The cached token may be stale (e.g. it was deleted in paperless-ngx), so get a fresh one and try again
+                self._logger.info("Auth token was rejected, trying to reacquire it...")
+                self._auth_token = self._acquire_auth_token(use_cache=False)
+                self._common_headers["Authorization"] = f"Token {self._auth_token}"
+                response = self._send(method, url, **kwargs)
+            return response
+        finally:
+            with self._stats_lock:
+                self.num_requests += 1
+                self.request_time += time.monotonic() - start_time
+
+    def _decode_json(self, response):
+        start_time = time.perf_counter()
+        content = response.content
+        body = _fast_json.loads(content) if _fast_json is not None else json.loads(content)
+        decode_time = time.perf_counter() - start_time
+        # The raw urllib3 response knows how many (possibly compressed) bytes were actually read from the wire
+        raw = getattr(response, "raw", None)
+        bytes_received = raw.tell() if hasattr(raw, "tell") else len(content)
+        with self._stats_lock:
+            self.num_decoded += 1
+            self.bytes_received += bytes_received
+            self.bytes_decoded += len(content)
+            self.decode_time += decode_time
+        return body
+
+    def _get_json(self, url, document_id=None, cache=True, uncached_keys=()):
+        '''GETs url, reusing or revalidating the cached response if there is one (and cache is True). Returns the json body, or None if there's no such thing (a 404).
+        Any other failure raises PaperlessAPIError, since it doesn't mean the thing isn't there.
+        Any of uncached_keys in the body are returned, but left out of the cache, so a cached body won't have them.'''
+        cached = self._response_cache.get(url) if cache else None
+        if cached is None:
+            response = self._request("GET", url)
+        else:
+            body, validators = cached
+            if len(validators) == 0:
+                self._response_cache.hits += 1
+                return body
+            response = self._request("GET", url, headers=validators)
+            if response.status_code == 304:
+                self._response_cache.revalidated += 1
+                return body
+        if not response.ok:
+            self._log_request_error(response)
+            if response.status_code == 404:
+                return None
+            raise PaperlessAPIError(f"Unable to get {url}: error {response.status_code} {response.reason}")
+        body = self._decode_json(response)
+        if cache:
+            self._response_cache.misses += 1
+            self._response_cache.put(url, body, response.headers, document_id, exclude=uncached_keys)
+        return body
+
+    def forget_unvalidated_responses(self):
+        '''Stops reusing cached responses that can't be revalidated, since they may have been changed by someone else since they were fetched'''
+        self._response_cache.forget_unvalidated()
+
     def delete_document_by_id(self, document_id):
         item_type = "documents"
         item_id = document_id
-        response = requests.delete(f"{self._api_url}/{item_type}/{item_id}/",
-                                   headers = self._common_headers)
+        response = self._request("DELETE", f"{self._api_url}/{item_type}/{item_id}/")
+        self._response_cache.invalidate(int(document_id))
         return response.ok
 
     def get_document_metadata_by_id(self, document_id):
-        response = requests.get(f"{self._api_url}/documents/{document_id}/metadata/",
-                                headers = self._common_headers)
-        if response.ok:
-            return response.json()
-        else:
-            self._log_request_error(response)
-            return {}
+        metadata = self._get_json(f"{self._api_url}/documents/{document_id}/metadata/", int(document_id))
+        return metadata if metadata is not None else {}
 
     def _log_request_error(self, response):
         self._logger.warning(f"Error {response.status_code} {response.reason} at {response.request.method} {response.url}: {response.text}")
         self._logger.debug(f"    Response headers: {response.headers}")
 
     def _get_item_by_id(self, item_type, item_id):
+        if item_id and item_type in self._cachable_types:
+            # Correspondents, tags, etc. are looked up in the cached list, which is only downloaded once, rather than one request each
+            item = self._get_cache_index(item_type).get(int(item_id))
+            if item is not None:
+                return item
         if item_id:
-            response = requests.get(f"{self._api_url}/{item_type}/{item_id}/",
-                                    headers = self._common_headers)
-            if response.ok:
-                return response.json()
-            self._log_request_error(response)
+            if item_type == "documents":
+                # A document's content can be large, and is fetched by itself when it's needed again (see get_document_content())
+                item = self._get_json(f"{self._api_url}/{item_type}/{item_id}/", int(item_id), uncached_keys=("content",))
+            else:
+                item = self._get_json(f"{self._api_url}/{item_type}/{item_id}/")
+            if item is not None:
+                return item
         return {}
 
     def _get_list(self, item_type, query=None):
@@ -69,21 +250,39 @@ class PaperlessAPI:
         next_url = f"{self._api_url}/{item_type}/"
         if query is not None:
             next_url += f"?{query}"
+        count = None
+        num_pages = 0
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            bytes_received, bytes_decoded, decode_time = self.bytes_received, self.bytes_decoded, self.decode_time
         while next_url is not None:
-            response = requests.get(next_url,
-                                    headers = self._common_headers)
+            response = self._request("GET", next_url)
             if response.ok:
-                response_json = response.json()
+                response_json = self._decode_json(response)
+                num_pages += 1
                 items.extend(response_json.get("results"))
                 next_url = response_json.get("next")
+                count = response_json.get("count", count)
             else:
-                next_url = None
+                # Returning a partial list here would silently skip documents, so fail loudly instead
+                self._log_request_error(response)
+                raise PaperlessAPIError(f"Unable to get the full list of {item_type} (got {len(items)} of {count if count is not None else 'unknown'}): error {response.status_code} {response.reason} at {next_url}")
+        if count is not None and count != len(items):
+            self._logger.warning(f"Expected {count} {item_type} but got {len(items)}. Were some added or deleted while we were listing them?")
+        if debug and num_pages > 0:
+            # Other threads may be decoding at the same time (e.g. in get_documents_by_ids()), so these are only approximately this list's
+            self._logger.debug(f"Listed {len(items)} {item_type} in {num_pages} pages: {(self.bytes_received - bytes_received) / num_pages / 1024:.1f}KiB per page on the wire ({(self.bytes_decoded - bytes_decoded) / num_pages / 1024:.1f}KiB uncompressed), {(self.decode_time - decode_time) * 1000 / num_pages:.2f}ms per page decoding json")
             
         if item_type in self._cachable_types:
             self._cache[item_type] = items
 
         return items
 
+    def _get_cache_index(self, item_type):
+        if item_type not in self._cache_index:
+            self._cache_index[item_type] = {item["id"]: item for item in self._get_list(item_type)}
+        return self._cache_index[item_type]
+
     def get_item_id_by_name(self, item_type, item_name):
         items = self._get_list(item_type)
         candidates = [item for item in items if item.get("name") == item_name]
@@ -91,12 +290,26 @@ class PaperlessAPI:
             return candidates[0].get("id")
         return None
 
+    def query_item_id_by_name(self, item_type, item_name):
+        '''Like get_item_id_by_name, but if the list of items isn't cached yet, asks the server for just the one item instead of downloading the whole list'''
+        if item_type in self._cache:
+            return self.get_item_id_by_name(item_type, item_name)
+        items = self._get_list(item_type, f"name__iexact={urllib.parse.quote(item_name)}")
+        candidates = [item for item in items if item.get("name") == item_name]
+        if len(candidates) > 0:
+            return candidates[0].get("id")
+        return None
+
     def patch_document(self, document_id, data):
-        response = requests.patch(f"{self._api_url}/documents/{document_id}/",
-                                  headers = self._common_headers,
-                                  data = data)
+        response = self._request("PATCH", f"{self._api_url}/documents/{document_id}/",
+                                 data = data)
+        # Whatever we had cached about the document is out of date now, even if the PATCH seemed to fail
+        self._response_cache.invalidate(int(document_id))
         if not response.ok:
             self._log_request_error(response)
+        elif self._mirror is not None:
+            # Keep the mirror current, so e.g. num_documents() sees the changes we just made. This isn't a sync though, since other documents may have changed too.
+            self._mirror.upsert_documents([response.json()], synced=False)
         return response
 
     def get_documents_by_selector_name(self, selector, name):
@@ -108,13 +321,55 @@ class PaperlessAPI:
             query = f"{selector}s__id={selector_id}"
         return self._get_list("documents", query) 
 
-    def get_documents_by_field_names(self, **fields):
+    def _get_document_ids(self, query=None):
+        # Paperless-ngx includes the IDs of every matching document in the "all" field of a list response, so one tiny page is enough
+        url = f"{self._api_url}/documents/?page_size=1&fields=id"
+        if query is not None:
+            url += f"&{query}"
+        response = self._request("GET", url)
+        if response.ok:
+            all_ids = response.json().get("all")
+            if all_ids is not None:
+                return all_ids
+        else:
+            self._log_request_error(response)
+        # Older versions don't have "all", so fall back to listing just the IDs
+        id_query = "fields=id&page_size=1000" + (f"&{query}" if query is not None else "")
+        return [document["id"] for document in self._get_list("documents", id_query)]
+
+    def _fields_query(self, document_fields):
+        return f"fields={','.join(document_fields)}" if document_fields is not None else None
+
+    def get_documents_by_ids(self, document_ids, batch_size=100, document_fields=None):
+        document_ids = list(document_ids)
+        fields_query = self._fields_query(document_fields)
+        queries = [f"id__in={','.join(str(document_id) for document_id in document_ids[start:start + batch_size])}&page_size={batch_size}" + (f"&{fields_query}" if fields_query is not None else "")
+                   for start in range(0, len(document_ids), batch_size)]
+        # The batches are independent, so fetch them in parallel. The controller keeps the number of requests actually in flight in check.
+        with ThreadPoolExecutor(max_workers=self._controller.max_concurrency) as executor:
+            batches = list(executor.map(lambda query: self._get_list("documents", query), queries))
+        return [document for batch in batches for document in batch]
+
+    def _get_documents(self, query=None, shard=None, document_fields=None):
+        if shard is None:
+            fields_query = self._fields_query(document_fields)
+            if fields_query is not None:
+                query = f"{query}&{fields_query}" if query is not None else fields_query
+            return self._get_list("documents", query)
+        # To only download the documents in our shard, we first get just the IDs of all the matching documents, and then fetch only the ones in our shard
+        shard_index, num_shards = shard
+        document_ids = sorted(document_id for document_id in self._get_document_ids(query) if document_id % num_shards == shard_index)
+        self._logger.debug(f"Shard {shard_index}/{num_shards} has {len(document_ids)} documents")
+        return self.get_documents_by_ids(document_ids, document_fields=document_fields)
+
+    def field_names_query(self, **fields):
+        '''Returns the query string selecting the documents with the given field values, or None if none of the fields can be queried'''
         allowed_fields = {"correspondent": "correspondent__name__iexact",
                           "document_type": "document_type__name__iexact",
                           "storage_path": "storage_path__name__iexact",
                           "added_year": "added__year",
                           "added_month": "added__month",
-                          "added_day": "added_day",
+                          "added_day": "added__day",
                           "asn": "archive_serial_number",
                           "title": "title__iexact",
                           "tag": "tags__name__iexact",
@@ -126,7 +381,7 @@ class PaperlessAPI:
         queries = []
         for key in allowed_fields.keys():
             if key in fields.keys() and fields[key] is not None:
-                queries.append(f"{allowed_fields[key]}={fields[key]}")
+                queries.append(f"{allowed_fields[key]}={urllib.parse.quote(str(fields[key]))}")
 
         if (isinstance(fields.get("added_range"), (tuple, list)) and
             len(fields.get("added_range")) == 2):
@@ -150,22 +405,93 @@ class PaperlessAPI:
             queries.append(f"created__year={fields['created_date_object'].year}&created__month={fields['created_date_object'].month}&created__day={fields['created_date_object'].day}")
 
         if len(queries) == 0:
+            return None
+        return "&".join(queries)
+
+    def get_documents_by_field_names(self, shard=None, document_fields=None, **fields):
+        mirror = self._get_mirror()
+        if mirror is not None:
+            document_ids = mirror.get_document_ids(**fields)
+            if document_ids is not None:
+                self._logger.debug(f"Local mirror has {len(document_ids)} documents matching {fields}")
+                if shard is not None:
+                    document_ids = [document_id for document_id in document_ids if document_id % shard[1] == shard[0]]
+                # The documents themselves still come from paperless-ngx, so they're always current
+                return self.get_documents_by_ids(document_ids, document_fields=document_fields)
+
+        query = self.field_names_query(**fields)
+        if query is None:
             self._logger.error(f"No query specified")
             return []
-
-        query = "&".join(queries)
         self._logger.debug(f"Running query '{query}'")
-        return self._get_list("documents", query)
+        return self._get_documents(query, shard, document_fields)
+
+    def count_documents_by_field_names(self, **fields):
+        '''Counts the documents get_documents_by_field_names() would return, without downloading them'''
+        mirror = self._get_mirror()
+        if mirror is not None:
+            count = mirror.count_documents(**fields)
+            if count is not None:
+                return count
+
+        query = self.field_names_query(**fields)
+        if query is None:
+            self._logger.error(f"No query specified")
+            return 0
+        return self._count_documents(query)
+
+    def _count_documents(self, query):
+        # Just one document per page is enough, since the response tells us how many there are in total
+        response = self._request("GET", f"{self._api_url}/documents/?{query}&page_size=1&fields=id")
+        if not response.ok:
+            self._log_request_error(response)
+            raise PaperlessAPIError(f"Unable to count documents: error {response.status_code} {response.reason}")
+        return response.json()["count"]
+
+    def _get_mirror(self):
+        if self._mirror is None and self._mirror_path is not None:
+            try:
+                self._mirror = LocalMirror(self._mirror_path)
+                self.sync_mirror()
+            except (PaperlessAPIError, requests.RequestException, sqlite3.Error, OSError, ValueError) as e:
+                self._logger.warning(f"Unable to use the local mirror at {self._mirror_path}, asking paperless-ngx directly instead: {e}")
+                self._mirror = None
+                self._mirror_path = None
+        return self._mirror
+
+    def sync_mirror(self):
+        '''Brings the local mirror up to date, by only downloading the documents that were modified since it was last synced'''
+        for item_type in self._cachable_types:
+            self._mirror.replace_items(item_type, self._get_list(item_type))
+        last_modified = self._mirror.get_last_modified()
+        query = f"page_size=1000&{self._fields_query(PaperlessAPI.metadata_fields)}"
+        if last_modified is not None:
+            query += f"&modified__gt={urllib.parse.quote(last_modified)}"
+        documents = self._get_list("documents", query)
+        self._mirror.upsert_documents(documents)
+        # Deleted documents don't show up as modified, so look for them by checking which IDs are gone
+        num_removed = self._mirror.remove_documents_except(self._get_document_ids())
+        self._logger.debug(f"Synced local mirror: {len(documents)} documents updated, {num_removed} removed")
+
 
 
     # def get_documents_from_query(self, query):
     #     return self._get_list("documents", query)
 
-    def get_all_documents(self):
-        return self._get_list("documents")
+    def get_all_documents(self, shard=None, document_fields=None):
+        return self._get_documents(shard=shard, document_fields=document_fields)
 
     def get_document_by_id(self, document_id):
         return self._get_item_by_id("documents", document_id)
+
+    def get_document_content(self, document_id):
+        # A document's content is usually only needed once, and can be large, so it isn't cached
+        try:
+            document = self._get_json(f"{self._api_url}/documents/{document_id}/?fields=id,content", int(document_id), cache=False)
+        except PaperlessAPIError:
+            # Already logged. One document's content missing shouldn't stop a whole run, it just keeps that document's metadata_regex from matching.
+            return None
+        return document.get("content") if document is not None else None
         
     def get_correspondent_by_id(self, correspondent_id):
         return self._get_item_by_id("correspondents", correspondent_id)
@@ -180,30 +506,12 @@ class PaperlessAPI:
         return self._get_item_by_id("tags", tag_id)
 
     def get_metadata_in_filename_format(self, metadata):
-        new_metadata = {}
-        new_metadata["document_id"] = metadata["id"]
-        new_metadata["correspondent"] = (self.get_correspondent_by_id(metadata["correspondent"])).get("name")
-        new_metadata["document_type"] = (self.get_document_type_by_id(metadata["document_type"])).get("name")
-        new_metadata["storage_path"] = (self.get_storage_path_by_id(metadata["storage_path"])).get("name")
-        new_metadata["asn"] = metadata["archive_serial_number"]
-        new_metadata["tag_list"] = [self.get_tag_by_id(tag)["name"] for tag in metadata["tags"]]
-        new_metadata["title"] = metadata["title"]
-        new_metadata["created"] = metadata["created"]
-        created_date = dateutil.parser.isoparse(new_metadata["created"])
-        new_metadata["created_year"] = f"{created_date.year:04d}"
-        new_metadata["created_month"] = f"{created_date.month:02d}"
-        new_metadata["created_day"] = f"{created_date.day:02d}"
-        new_metadata["created_date"] = created_date.strftime("%F") # %F means YYYY-MM-DD
-        new_metadata["created_date_object"] = created_date
-        new_metadata["added"] = metadata["added"]
-        added_date = dateutil.parser.isoparse(new_metadata["added"])
-        new_metadata["added_year"] = f"{added_date.year:04d}"
-        new_metadata["added_month"] = f"{added_date.month:02d}"
-        new_metadata["added_day"] = f"{added_date.day:02d}"
-        new_metadata["added_date"] = added_date.strftime("%F")
-        new_metadata["added_date_object"] = added_date
-        
-        return new_metadata
+        # The created_*/added_* fields (created_year, created_date, added_date_object, etc.) are worked out from created and added when they're first used
+        return DocumentMetadata.from_document(metadata,
+                                              correspondent = (self.get_correspondent_by_id(metadata["correspondent"])).get("name"),
+                                              document_type = (self.get_document_type_by_id(metadata["document_type"])).get("name"),
+                                              storage_path = (self.get_storage_path_by_id(metadata["storage_path"])).get("name"),
+                                              tag_list = [self.get_tag_by_id(tag)["name"] for tag in metadata["tags"]])
 
     def get_metadata_from_filename_format(self, metadata_in_filename_format):
         result = {}
@@ -220,9 +528,10 @@ class PaperlessAPI:
         
         return result
         
-    def get_metadata_for_post_consume_script(self, document_id):
+    def get_metadata_for_post_consume_script(self, document_id, document=None):
         result = {}
-        document = self.get_document_by_id(document_id)
+        if document is None:
+            document = self.get_document_by_id(document_id)
         document_metadata = self.get_document_metadata_by_id(document_id)
         result["DOCUMENT_ID"] = str(document_id)
         result["DOCUMENT_FILE_NAME"] = document.get("original_file_name")
@@ -0,0 +1,28 @@
+import json
+import time
+
+class PhaseTimer:
+    '''Records how long each phase of a run takes, e.g. so benchmarks/hook_load_test.py can see where the post-consume hook spends its time.
+
+    Each call to lap() attributes the time since the previous lap to the given phase. If a PaperlessAPI is
+    passed to lap(), the time spent waiting on its requests during that phase is recorded separately too.'''
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.time()
+        self.phases = {}
+        self.request_times = {}
+        self._last = self.started
+        self._last_request_time = 0.0
+
+    def lap(self, phase, api=None):
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+        if api is not None:
+            self.request_times[phase] = self.request_times.get(phase, 0.0) + api.request_time - self._last_request_time
+            self._last_request_time = api.request_time
+
+    def write(self, filename, **extra):
+        '''Appends the timings as a single line of json to filename'''
+        record = {"started": self.started, "phases": self.phases, "request_times": self.request_times, **extra}
+        with open(filename, "a") as timings_file:
+            timings_file.write(json.dumps(record) + "\n")
@@ -1,16 +1,37 @@
 import calendar
 import dateutil.parser
+import hashlib
 import jinja2
+import jinja2.meta
+import jinja2.nodes
 import logging
 import regex
+import threading
+import time
 import yaml
 from datetime import date, datetime, timedelta
 from pathlib import Path
 
-from .paperless_api import PaperlessAPI
+from .paperless_api import PaperlessAPI, PaperlessAPIError
+from .regex_prefilter import RegexPrefilter, required_literals
+from .ruleset_cache import RulesetCache, stat_ruleset_file
 
 class DocumentRuleProcessor:
-    def __init__(self, api, spec, logger = None):
+    # The parts of the created date that rules can change, and every key that's derived from them
+    _created_date_parts = frozenset(["created_year", "created_month", "created_day"])
+    _created_date_keys = _created_date_parts | frozenset(["created", "created_date", "created_date_object"])
+    # Rules can't change these
+    _read_only_keys = frozenset(["correspondent",
+                                 "document_type",
+                                 "storage_path",
+                                 "tag_list",
+                                 "added",
+                                 "added_year",
+                                 "added_month",
+                                 "added_day",
+                                 "document_id"])
+
+    def __init__(self, api, spec, logger = None, compiled_templates = None):
         self._logger = logger
         if self._logger is None:
             logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", level="CRITICAL")
@@ -19,10 +40,13 @@ class DocumentRuleProcessor:
         self._api = api
 
         self.name = list(spec.keys())[0]
+        self.spec = spec
         self._match = spec[self.name].get("match")
         self._metadata_regex = spec[self.name].get("metadata_regex")
         self._metadata_postprocessing = spec[self.name].get("metadata_postprocessing")
         self._validation_rule = spec[self.name].get("validation_rule")
+        # Rules can opt out of having their metadata_regex skipped when the prefilter doesn't find its literals
+        self._metadata_regex_prefilter = spec[self.name].get("metadata_regex_prefilter", True)
         #self._title_format = spec[self.name].get("title_format")
 
         self._env = jinja2.Environment()
@@ -34,14 +58,151 @@ class DocumentRuleProcessor:
         self._env.globals["date"] = date
         self._env.globals["timedelta"] = timedelta
 
-    def matches(self, metadata):
+        # Templates are compiled the first time they're used, and then reused for every document after that.
+        # compiled_templates maps template sources to the python code jinja generated for them and the variables they reference (e.g. from a RulesetCache), which lets us skip jinja's parsing and code generation entirely.
+        self._compiled_templates = compiled_templates if compiled_templates is not None else {}
+        self._templates = {}
+        self._compiled_metadata_regex = None
+        self._regex_literals = None
+
+        # Per-rule statistics. These survive a Postprocessor.reload_rules() as long as the rule itself doesn't change.
+        self.stats = {"matched": 0, "not_matched": 0, "invalid": 0, "regex_skipped": 0}
+
+    def _get_template(self, source):
+        template = self._templates.get(source)
+        if template is None:
+            compiled_template = self._compiled_templates.get(source)
+            if compiled_template is not None:
+                template = self._env.template_class.from_code(self._env, compile(compiled_template["code"], "<template>", "exec"), self._env.make_globals(None), None)
+            else:
+                template = self._env.from_string(source)
+            self._templates[source] = template
+        return template
+
+    @property
+    def uses_content(self):
+        # Only the metadata regex looks at a document's content, the templates never see it
+        return self._metadata_regex is not None
+
+    def _get_metadata_regex(self):
+        if self._compiled_metadata_regex is None:
+            self._compiled_metadata_regex = regex.compile(self._metadata_regex)
+        return self._compiled_metadata_regex
+
+    @property
+    def regex_literals(self):
+        '''The literals at least one of which must be in a document's content for the metadata regex to match, or None if the regex should always be run'''
+        if self._metadata_regex is None or self._metadata_regex_prefilter is False:
+            return None
+        if self._regex_literals is None:
+            # Wrapped in a tuple, so a regex without any literals isn't worked out again every time
+            self._regex_literals = (required_literals(self._metadata_regex),)
+        return self._regex_literals[0]
+
+    def template_sources(self):
+        sources = []
         if type(self._match) is str:
-            template = self._env.from_string(self._match)
-            return template.render(**metadata) == "True"
+            sources.append(self._match)
+        if self._metadata_postprocessing is not None:
+            sources.extend(value for value in self._metadata_postprocessing.values() if type(value) is str)
+        if self._validation_rule is not None:
+            sources.append(self._validation_rule)
+        return sources
+
+    def _compile_template(self, source):
+        ast = self._env.parse(source)
+        return {"code": self._env.compile(ast, raw=True),
+                "variables": frozenset(jinja2.meta.find_undeclared_variables(ast))}
+
+    def compile_templates(self):
+        '''Returns a dict mapping each of this rule's template sources to the python code jinja generates for it and the variables it references'''
+        for source in self.template_sources():
+            if source not in self._compiled_templates:
+                try:
+                    self._compiled_templates[source] = self._compile_template(source)
+                except jinja2.TemplateError:
+                    # Broken templates are left uncompiled, so the error gets reported when the template is actually used
+                    pass
+        return self._compiled_templates
+
+    def _template_variables(self, source):
+        '''Returns the set of variables the given template references, or None if we can't tell'''
+        compiled_template = self._compiled_templates.get(source)
+        if compiled_template is None:
+            try:
+                compiled_template = self._compile_template(source)
+            except jinja2.TemplateError:
+                return None
+            self._compiled_templates[source] = compiled_template
+        return compiled_template["variables"]
+
+    # The metadata fields that can be compared with == in a match template, and the selector each one translates to
+    _query_field_names = {"correspondent": "correspondent",
+                          "document_type": "document_type",
+                          "storage_path": "storage_path",
+                          "title": "title",
+                          "asn": "asn",
+                          "created_year": "created_year",
+                          "created_month": "created_month",
+                          "created_day": "created_day",
+                          "added_year": "added_year",
+                          "added_month": "added_month",
+                          "added_day": "added_day"}
+
+    def get_query_fields(self):
+        '''Translates the simple parts of the match template into selectors for PaperlessAPI.get_documents_by_field_names().
+
+        Only comparisons like "correspondent == 'The Bank'" or "'Some Tag' in tag_list" that are
+        and-ed together at the top level of the template are translated; anything else is ignored.
+        So every document the rule matches will be selected, but some selected documents may
+        still not match. Returns None if the rule never matches.'''
+        if type(self._match) is bool:
+            return {} if self._match else None
+        if type(self._match) is not str:
+            return None
+
+        try:
+            ast = self._env.parse(self._match)
+        except jinja2.TemplateError:
+            return {}
+        if len(ast.body) != 1 or not isinstance(ast.body[0], jinja2.nodes.Output) or len(ast.body[0].nodes) != 1:
+            return {}
+
+        fields = {}
+        conditions = [ast.body[0].nodes[0]]
+        while len(conditions) > 0:
+            condition = conditions.pop(0)
+            if isinstance(condition, jinja2.nodes.And):
+                conditions.extend([condition.left, condition.right])
+            elif isinstance(condition, jinja2.nodes.Compare) and len(condition.ops) == 1:
+                left, op, right = condition.expr, condition.ops[0].op, condition.ops[0].expr
+                if op == "eq" and isinstance(right, jinja2.nodes.Name) and isinstance(left, jinja2.nodes.Const):
+                    left, right = right, left
+                if op == "eq" and isinstance(left, jinja2.nodes.Name) and isinstance(right, jinja2.nodes.Const) and right.value is not None:
+                    if left.name in DocumentRuleProcessor._query_field_names:
+                        fields.setdefault(DocumentRuleProcessor._query_field_names[left.name], right.value)
+                    elif left.name in ["created_date", "added_date"]:
+                        try:
+                            fields.setdefault(f"{left.name}_object", dateutil.parser.isoparse(str(right.value)).date())
+                        except ValueError:
+                            pass
+                elif op == "in" and isinstance(left, jinja2.nodes.Const) and isinstance(right, jinja2.nodes.Name) and right.name == "tag_list":
+                    # We can only select on one tag, any others are checked when the template is evaluated
+                    fields.setdefault("tag", left.value)
+        return fields
+
+    def matches(self, metadata, count=True):
+        '''Whether the rule's match template matches the metadata, counted in the rule's stats unless count is False'''
+        if type(self._match) is str:
+            template = self._get_template(self._match)
+            result = template.render(**metadata) == "True"
         elif type(self._match) is bool:
-            return self._match
+            result = self._match
         else:
-            return False
+            result = False
+        if count:
+            self.stats["matched" if result else "not_matched"] += 1
+        return result
 
     def _normalize_month(self, new_month, old_month):
         try:
@@ -121,10 +282,10 @@ class DocumentRuleProcessor:
         # self._logger.debug(f"Running query '{query}'")
 
         #items = self._api.get_documents_from_query(query)
-        items = self._api.get_documents_by_field_names(**constraints)
-        self._logger.debug(f"Found {len(items)} documents matching the query")
+        num_items = self._api.count_documents_by_field_names(**constraints)
+        self._logger.debug(f"Found {num_items} documents matching the query")
 
-        return len(items)
+        return num_items
 
     def _jinja_filter_regex_match(self, string, pattern):
         '''Custom jinja filter for regex matching'''
@@ -156,71 +317,112 @@ class DocumentRuleProcessor:
 
     def validate(self, metadata):
         valid = True
+        # Checked once up front, so the (large) debug messages aren't even formatted unless they'll be logged
+        debug = self._logger.isEnabledFor(logging.DEBUG)
 
         metadata = self._normalize_created_dates(metadata, metadata)
 
         # Try to apply the validation rule
         if self._validation_rule is not None:
-            self._logger.debug(f"Validating for rule {self.name} using metadata={metadata}")
-            template = self._env.from_string(self._validation_rule)
+            if debug:
+                self._logger.debug(f"Validating for rule {self.name} using metadata={metadata}")
+            template = self._get_template(self._validation_rule)
             template_result = template.render(**metadata).strip()
-            self._logger.debug(f"Validation template rendered to '{template_result}'")
+            if debug:
+                self._logger.debug(f"Validation template rendered to '{template_result}'")
             valid = (template_result != "False")
             if not valid:
+                self.stats["invalid"] += 1
                 self._logger.warning(f"Failed validation rule '{self._validation_rule}'")
-        else:
+        elif debug:
             self._logger.debug(f"No validation rule found for {self.name}")
 
         return valid
         
-    def get_new_metadata(self, metadata, content):
-        read_only_metadata_keys = ["correspondent",
-                                   "document_type",
-                                   "storage_path",
-                                   "tag_list",
-                                   "added",
-                                   "added_year",
-                                   "added_month",
-                                   "added_day",
-                                   "document_id"]
-        read_only_metadata = {key: metadata[key] for key in read_only_metadata_keys if key in metadata}
-        writable_metadata_keys = list(set(metadata.keys()) - set(read_only_metadata_keys))
-        writable_metadata = {key: metadata[key] for key in writable_metadata_keys if key in metadata}
+    def get_new_metadata(self, metadata, content, regex_may_match=True):
+        # We work on a copy of the metadata, which also serves as the context for the templates.
+        # Since changes to read-only keys are never kept, it always looks exactly like the writable
+        # metadata merged with the read-only metadata would.
+        new_metadata = metadata.copy()
+        # Checked once up front, so the (large) debug messages aren't even formatted unless they'll be logged
+        debug = self._logger.isEnabledFor(logging.DEBUG)
         
+        # Whether the created date keys have been normalized yet, see below
+        created_date_normalized = False
+
         # Extract the regex_data
         if self._metadata_regex is not None:
-            match_object = regex.search(self._metadata_regex, content)
+            if regex_may_match:
+                match_object = self._get_metadata_regex().search(content)
+            else:
+                # The prefilter didn't find any of the literals the regex needs, so it can't match
+                match_object = None
+                self.stats["regex_skipped"] += 1
             if match_object is not None:
                 regex_data = match_object.groupdict()
                 #writable_metadata.update(match_object.groupdict())
-                writable_metadata.update([(k, regex_data[k]) for k in regex_data if regex_data[k] is not None])
-                writable_metadata = self._normalize_created_dates(writable_metadata, metadata)
-                self._logger.debug(f"Regex results are {writable_metadata}")
+                new_metadata.update([(k, regex_data[k]) for k in regex_data if regex_data[k] is not None and k not in DocumentRuleProcessor._read_only_keys])
+                new_metadata = self._normalize_created_dates(new_metadata, metadata)
+                created_date_normalized = True
+                if debug:
+                    self._logger.debug(f"Regex results are {new_metadata}")
             else:
                 self._logger.warning(f"Regex '{self._metadata_regex}' for '{self.name}' didn't match for document_id={metadata['document_id']}")
 
         # Cycle throguh the postprocessing rules
         if self._metadata_postprocessing is not None:
+            # The created date keys are normalized (e.g. created_date_object becomes a date rather than a
+            # datetime) once the first variable has been updated, and again whenever any of them changes.
+            # Rather than doing that after every variable, we only do it once a template (or the final
+            # result) actually needs it, which gives the templates exactly the same values.
+            created_date_dirty = False
             for variable_name in self._metadata_postprocessing.keys():
                 try:
-                    old_value = writable_metadata.get(variable_name)
-                    merged_metadata = {**writable_metadata, **read_only_metadata}
-                    template = self._env.from_string(self._metadata_postprocessing[variable_name])
-                    writable_metadata[variable_name] = template.render(**merged_metadata)
-                    writable_metadata = self._normalize_created_dates(writable_metadata, metadata)
-                    self._logger.debug(f"Updating '{variable_name}' using template {self._metadata_postprocessing[variable_name]} and metadata {merged_metadata}\n: '{old_value}'->'{writable_metadata[variable_name]}'")
+                    source = self._metadata_postprocessing[variable_name]
+                    if created_date_dirty:
+                        variables = self._template_variables(source)
+                        if variables is None or not variables.isdisjoint(DocumentRuleProcessor._created_date_keys):
+                            try:
+                                new_metadata = self._normalize_created_dates(new_metadata, metadata)
+                                created_date_dirty = False
+                                created_date_normalized = True
+                            except Exception as e:
+                                # Just like a template error, an invalid date doesn't stop the rest of the variables from being processed
+                                self._logger.error(f"Error normalizing created date for rule {self.name} before updating {variable_name}: {e}")
+                    old_value = new_metadata.get(variable_name)
+                    template = self._get_template(source)
+                    new_value = template.render(**new_metadata)
+                    if not created_date_normalized:
+                        created_date_dirty = True
+                    if variable_name in DocumentRuleProcessor._read_only_keys:
+                        if debug:
+                            self._logger.debug(f"Ignoring new value '{new_value}' for read-only '{variable_name}'")
+                        continue
+                    new_metadata[variable_name] = new_value
+                    # Writing any of the created date keys (not just its parts) means they all have to be derived from the parts again
+                    if variable_name in DocumentRuleProcessor._created_date_keys and new_value != old_value:
+                        created_date_dirty = True
+                        created_date_normalized = False
+                    if debug:
+                        self._logger.debug(f"Updating '{variable_name}' using template {source} and metadata {new_metadata}\n: '{old_value}'->'{new_value}'")
                 except Exception as e:
-                    self._logger.error(f"Error parsing template {self._metadata_postprocessing[variable_name]} for {variable_name} using metadata {merged_metadata}: {e}")
+                    self._logger.error(f"Error parsing template {self._metadata_postprocessing[variable_name]} for {variable_name} using metadata {new_metadata}: {e}")
 
-        else:
+            if created_date_dirty:
+                try:
+                    new_metadata = self._normalize_created_dates(new_metadata, metadata)
+                except Exception as e:
+                    self._logger.error(f"Error normalizing created date for rule {self.name}: {e}")
+
+        elif debug:
             self._logger.debug(f"No postprocessing rules found for rule {self.name}")
 
-        return {**writable_metadata, **read_only_metadata}
+        return new_metadata
 
 
 
 class Postprocessor:
-    def __init__(self, api, rules_dir, postprocessing_tag = None, invalid_tag = None, dry_run = False, skip_validation = False, logger = None):
+    def __init__(self, api, rules_dir, postprocessing_tag = None, invalid_tag = None, dry_run = False, skip_validation = False, logger = None, cache_dir = None, reload_interval = None, log_every = 1):
         self._logger = logger
         if self._logger is None:
             logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", level="CRITICAL")
@@ -241,94 +443,285 @@ class Postprocessor:
 
         self._dry_run = dry_run
         self._skip_validation = skip_validation
+        self._log_every = max(1, int(log_every))
+        self._num_documents = 0
+
+        self._ruleset_cache = RulesetCache(cache_dir, self._logger) if cache_dir is not None else None
 
         self._processors = []
-    
-        for filename in sorted(list(self._rules_dir.glob("*.yml"))):
-            if filename.is_file():
-                with open(filename, "r") as yaml_file:
-                    try:
-                        yaml_documents = yaml.safe_load_all(yaml_file)
-                        for yaml_document in yaml_documents:
-                            self._processors.append(DocumentRuleProcessor(self._api, yaml_document, self._logger))
-                    except Exception as e:
-                        self._logger.warning(f"Unable to parse yaml in {filename}: {e}")
+        # The prefilter for the metadata regexes, along with the list of processors it was built for
+        self._prefilter = (None, None)
+        self._num_regex_skipped = 0
+        # Maps each ruleset filename to its fingerprint and the processors loaded from it
+        self._ruleset_files = {}
+        self._reload_lock = threading.Lock()
+        # If reload_interval is set, postprocess() checks rules_dir for changes at most every reload_interval seconds, in between documents
+        self._reload_interval = reload_interval
+        self._last_reload_check = time.monotonic()
+
+        self.reload_rules()
         self._logger.debug(f"Loaded {len(self._processors)} rules")
 
+    def reload_rules(self):
+        '''Rereads any ruleset files in rules_dir that changed since they were last loaded.
+
+        Unchanged rules keep their processors (and so their compiled templates and statistics).
+        The new list of rules replaces the old one in a single step, so a document is always
+        processed entirely with either the old or the new rules. Returns True if anything changed.'''
+        with self._reload_lock:
+            self._last_reload_check = time.monotonic()
+            filenames = [filename for filename in sorted(list(self._rules_dir.glob("*.yml"))) if filename.is_file()]
+
+            old_processors = {}
+            for (_, processors) in self._ruleset_files.values():
+                for processor in processors:
+                    old_processors.setdefault(processor.name, []).append(processor)
+
+            changed = set(self._ruleset_files.keys()) != set(filenames)
+            ruleset_files = {}
+            for filename in filenames:
+                old_fingerprint, old_file_processors = self._ruleset_files.get(filename, (None, []))
+                try:
+                    fingerprint = stat_ruleset_file(filename, old_fingerprint)
+                except OSError as e:
+                    self._logger.warning(f"Unable to read {filename}: {e}")
+                    continue
+                if fingerprint == old_fingerprint:
+                    ruleset_files[filename] = (fingerprint, old_file_processors)
+                    continue
+
+                changed = True
+                self._logger.debug(f"Loading rules from {filename}")
+                processors = []
+                for processor in self._load_ruleset_file(filename, fingerprint):
+                    # Keep the existing processor for any rule that didn't actually change, so it keeps its statistics
+                    candidates = [old for old in old_processors.get(processor.name, []) if old.spec == processor.spec]
+                    if len(candidates) > 0:
+                        processor = candidates[0]
+                        old_processors[processor.name].remove(processor)
+                    processors.append(processor)
+                ruleset_files[filename] = (fingerprint, processors)
+
+            if self._ruleset_cache is not None:
+                self._ruleset_cache.prune(filenames)
+                self._ruleset_cache.save()
+
+            if changed:
+                self._ruleset_files = ruleset_files
+                self._processors = [processor for (_, processors) in ruleset_files.values() for processor in processors]
+            return changed
+
+    def _reload_rules_if_due(self):
+        if self._reload_interval is not None and time.monotonic() - self._last_reload_check >= self._reload_interval:
+            if self.reload_rules():
+                self._logger.info(f"Reloaded rules, now using {len(self._processors)} rules")
+
+    def get_rule(self, name):
+        candidates = [processor for processor in self._processors if processor.name == name]
+        return candidates[0] if len(candidates) > 0 else None
+
+    def filter_documents_by_rule(self, name, documents):
+        '''Returns only the documents that the given rule's match template actually matches'''
+        processor = self.get_rule(name)
+        # Not counted, since postprocess() checks the same documents again
+        return [document for document in documents if processor.matches(self._api.get_metadata_in_filename_format(document), count=False)]
+
+    def rules_fingerprint(self):
+        '''A hash of the contents of all the ruleset files, which changes whenever any of the rules does'''
+        digest = hashlib.sha256()
+        for filename, (fingerprint, _) in sorted(self._ruleset_files.items()):
+            digest.update(f"{filename.name}:{fingerprint.sha256}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def rule_statistics(self):
+        return {processor.name: dict(processor.stats) for processor in self._processors}
+
+    def _load_ruleset_file(self, filename, fingerprint):
+        if self._ruleset_cache is not None:
+            cached = self._ruleset_cache.get(filename)
+            if cached is not None:
+                specs, compiled_templates = cached
+                self._logger.debug(f"Using cached rules for {filename}")
+                return [DocumentRuleProcessor(self._api, spec, self._logger, compiled_templates) for spec in specs]
+
+        processors = []
+        specs = []
+        with open(filename, "r") as yaml_file:
+            try:
+                yaml_documents = yaml.safe_load_all(yaml_file)
+                for yaml_document in yaml_documents:
+                    processors.append(DocumentRuleProcessor(self._api, yaml_document, self._logger))
+                    specs.append(yaml_document)
+            except Exception as e:
+                self._logger.warning(f"Unable to parse yaml in {filename}: {e}")
+                # Don't cache files with errors, so the error gets reported every time
+                return processors
+
+        if self._ruleset_cache is not None:
+            compiled_templates = {}
+            for processor in processors:
+                compiled_templates.update(processor.compile_templates())
+            self._ruleset_cache.put(filename, fingerprint, specs, compiled_templates)
+        return processors
+
         
-    def _get_new_metadata_in_filename_format(self, metadata_in_filename_format, content):
+    def _get_new_metadata_in_filename_format(self, processors, metadata_in_filename_format, get_content):
         new_metadata = metadata_in_filename_format.copy()
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        prefilter = self._get_prefilter(processors)
+        # The literals found in the content, which is only scanned once a matching rule needs it
+        present_literals = None
         
-        for processor in self._processors:
+        for processor in processors:
             if processor.matches(metadata_in_filename_format):
-                self._logger.debug(f"Rule {processor.name} matches")
-                new_metadata = processor.get_new_metadata(metadata_in_filename_format, content)
-                metadata_in_filename_format = {**metadata_in_filename_format, **new_metadata}
-            else:
+                if debug:
+                    self._logger.debug(f"Rule {processor.name} matches")
+                content = None
+                regex_may_match = True
+                if processor.uses_content:
+                    content = get_content()
+                    if len(prefilter) > 0:
+                        if present_literals is None:
+                            present_literals = prefilter.scan(content)
+                        regex_may_match = prefilter.may_match(processor, present_literals)
+                        if not regex_may_match:
+                            self._num_regex_skipped += 1
+                            if debug:
+                                self._logger.debug(f"Skipping the regex for rule {processor.name}, since none of {processor.regex_literals} is in the content")
+                new_metadata = processor.get_new_metadata(metadata_in_filename_format, content, regex_may_match)
+                # The new metadata already contains everything from the old, so the next rule can just build on it
+                metadata_in_filename_format = new_metadata
+            elif debug:
                 self._logger.debug(f"Rule {processor.name} does not match")
 
         return new_metadata
 
-    def _validate(self, metadata_in_filename_format):
-        for processor in self._processors:
+    def _get_prefilter(self, processors):
+        prefilter_processors, prefilter = self._prefilter
+        if prefilter_processors is not processors:
+            # The rules were (re)loaded since the prefilter was built
+            prefilter = RegexPrefilter(processors)
+            self._prefilter = (processors, prefilter)
+            self._logger.debug(f"Prefiltering the metadata regexes of {len(prefilter)}/{len([processor for processor in processors if processor.uses_content])} rules")
+        return prefilter
+
+    def _validate(self, processors, metadata_in_filename_format):
+        for processor in processors:
             if processor.matches(metadata_in_filename_format):
                 if not processor.validate(metadata_in_filename_format):
                     return False
         return True
 
-    def postprocess(self, documents):
+    def _content_getter(self, document):
+        '''Returns a function that returns the document's content, only fetching it the first time it's needed if the document was listed without it'''
+        content = [document.get("content")]
+        def get_content():
+            if content[0] is None:
+                self._logger.debug(f"Fetching content for document_id={document['id']}")
+                content[0] = self._api.get_document_content(document["id"]) or ""
+            return content[0]
+        return get_content
+
+    def postprocess(self, documents, on_document_done=None):
+        '''Postprocesses the given documents, and returns the backup documents. If given, on_document_done(document, backup_documents) is called after each document is done.'''
         backup_documents = []
         num_invalid = 0
+        num_regex_skipped = self._num_regex_skipped
+        self._api.forget_unvalidated_responses()
         for document in documents:
-            metadata_in_filename_format = self._api.get_metadata_in_filename_format(document)
+            self._reload_rules_if_due()
+            # Take a snapshot of the rules, so a concurrent reload_rules() can't change them halfway through a document
+            processors = self._processors
+
+            document_backup_documents, valid, _ = self._postprocess_document(processors, document)
+            backup_documents.extend(document_backup_documents)
+            if not valid:
+                num_invalid += 1
+            if on_document_done is not None:
+                on_document_done(document, document_backup_documents)
+
+        if num_invalid > 0:
+            self._logger.warning(f"Found {num_invalid}/{len(documents)} invalid documents")
+        if self._num_regex_skipped > num_regex_skipped:
+            self._logger.info(f"Skipped {self._num_regex_skipped - num_regex_skipped} metadata_regex searches whose literals weren't in the content")
+
+        return backup_documents
+
+    def postprocess_document(self, document):
+        '''Postprocesses a single document. Returns the backup documents, and the document as it is after postprocessing (without refetching it).
+        Unlike postprocess(), raises PaperlessAPIError if changing the document fails, so the caller can try again later.'''
+        self._reload_rules_if_due()
+        self._api.forget_unvalidated_responses()
+        backup_documents, _, document = self._postprocess_document(self._processors, document, raise_patch_errors=True)
+        return backup_documents, document
+
+    def _patch_document(self, document, data, raise_errors=False):
+        # Paperless-ngx answers a PATCH with the updated document, so we can keep using that instead of fetching it again
+        response = self._api.patch_document(document["id"], data)
+        if response.ok:
+            return response.json()
+        if raise_errors:
+            raise PaperlessAPIError(f"Unable to change document_id={document['id']}: error {response.status_code} {response.reason}")
+        return document
+
+    def _postprocess_document(self, processors, document, raise_patch_errors=False):
+        backup_documents = []
+        valid = True
+
+        # Only one in every log_every documents gets its info messages logged, so big runs don't drown in them
+        info = self._logger.isEnabledFor(logging.INFO) and self._num_documents % self._log_every == 0
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        self._num_documents += 1
+
+        metadata_in_filename_format = self._api.get_metadata_in_filename_format(document)
+        if debug:
             self._logger.debug(f"metadata_in_filename_format={metadata_in_filename_format}")
-            new_metadata_in_filename_format = self._get_new_metadata_in_filename_format(metadata_in_filename_format, document["content"])
+        new_metadata_in_filename_format = self._get_new_metadata_in_filename_format(processors, metadata_in_filename_format, self._content_getter(document))
+        if debug:
             self._logger.debug(f"new_metadata_in_filename_format={new_metadata_in_filename_format}")
-            if len([key for key in metadata_in_filename_format.keys() if metadata_in_filename_format[key] != new_metadata_in_filename_format.get(key)]) > 0:
-                new_metadata = self._api.get_metadata_from_filename_format(new_metadata_in_filename_format)
-                # differences should be a list of keys that have changed
+        current_document = document
+        if len([key for key in metadata_in_filename_format.keys() if metadata_in_filename_format[key] != new_metadata_in_filename_format.get(key)]) > 0:
+            new_metadata = self._api.get_metadata_from_filename_format(new_metadata_in_filename_format)
+            # differences should be a list of keys that have changed
+            differences = [key for key in new_metadata.keys() if new_metadata[key] != document[key]]
+            if len(differences) > 0 and self._postprocessing_tag_id is not None:
+                new_metadata["tags"].append(self._postprocessing_tag_id)
                 differences = [key for key in new_metadata.keys() if new_metadata[key] != document[key]]
-                if len(differences) > 0 and self._postprocessing_tag_id is not None:
-                    new_metadata["tags"].append(self._postprocessing_tag_id)
-                    differences = [key for key in new_metadata.keys() if new_metadata[key] != document[key]]
-                if len(differences) > 0:
+            if len(differences) > 0:
+                if info:
                     self._logger.info(f"Changes for document_id={document['id']}:")
                     for key in differences:
                         self._logger.info(f" {key}: '{document[key]}' --> '{new_metadata[key]}'")                        
-                    if not self._dry_run:
-                        differences.append("created_date")
-                        self._api.patch_document(document["id"], {key: new_metadata[key] for key in differences})
-                        backup_data = {key: document[key] for key in differences}
-                        backup_data["id"] = document["id"]
-                        backup_documents.append(backup_data)                        
-                else:
-                    self._logger.info(f"No changes for document_id={document['id']}")
-            else:
+                if not self._dry_run:
+                    differences.append("created_date")
+                    current_document = self._patch_document(document, {key: new_metadata[key] for key in differences}, raise_patch_errors)
+                    backup_data = {key: document[key] for key in differences}
+                    backup_data["id"] = document["id"]
+                    backup_documents.append(backup_data)                        
+            elif info:
                 self._logger.info(f"No changes for document_id={document['id']}")
-
-            if (not self._skip_validation) and (self._invalid_tag_id is not None):
-                # Note that we have to refetch the document here to get the changes we just applied from postprocessing
-                metadata_in_filename_format = self._api.get_metadata_in_filename_format(self._api.get_document_by_id(document['id']))
-                metadata = self._api.get_metadata_from_filename_format(metadata_in_filename_format)
-                valid = self._validate(metadata_in_filename_format)
-                if not valid:
-                    num_invalid += 1
-                    metadata["tags"].append(self._invalid_tag_id)
-                    self._logger.warning(f"document_id={document['id']} is invalid, adding tag {self._invalid_tag_id}")
-                    if not self._dry_run:
-                        self._api.patch_document(document["id"], {"tags": metadata["tags"]})
-                        backup_data = {"tags": metadata["tags"]}
-                        backup_data["id"] = document["id"]
-                        backup_documents.append(backup_data)
-                else:
-                    self._logger.info(f"document_id={document['id']} is valid")
-            else:
-                self._logger.info(f"Validation was skipped since invalid_tag_id={self._invalid_tag_id} and skip_validation={self._skip_validation}")
-
-        if num_invalid > 0:
-            self._logger.warning(f"Found {num_invalid}/{len(documents)} invalid documents")
-
-        return backup_documents
+        elif info:
+            self._logger.info(f"No changes for document_id={document['id']}")
+
+        if (not self._skip_validation) and (self._invalid_tag_id is not None):
+            # Note that we have to validate the document as it is after the changes we just applied from postprocessing
+            metadata_in_filename_format = self._api.get_metadata_in_filename_format(current_document)
+            metadata = self._api.get_metadata_from_filename_format(metadata_in_filename_format)
+            valid = self._validate(processors, metadata_in_filename_format)
+            if not valid:
+                metadata["tags"].append(self._invalid_tag_id)
+                self._logger.warning(f"document_id={document['id']} is invalid, adding tag {self._invalid_tag_id}")
+                if not self._dry_run:
+                    current_document = self._patch_document(current_document, {"tags": metadata["tags"]}, raise_patch_errors)
+                    backup_data = {"tags": metadata["tags"]}
+                    backup_data["id"] = document["id"]
+                    backup_documents.append(backup_data)
+            elif info:
+                self._logger.info(f"document_id={document['id']} is valid")
+        elif info:
+            self._logger.info(f"Validation was skipped since invalid_tag_id={self._invalid_tag_id} and skip_validation={self._skip_validation}")
+
+        return backup_documents, valid, current_document
         
 #         # if "created_year" in regex_data.keys():
 #         #     metadata["created_year"] = regex_data["created_year"]
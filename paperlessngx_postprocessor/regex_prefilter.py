@@ -0,0 +1,130 @@
+import re
+import regex
+try:
+    import re._parser as regex_parser
+    import re._constants as regex_constants
+except ImportError:
+    # Before python 3.11
+    import sre_parse as regex_parser
+    import sre_constants as regex_constants
+
+# Literals shorter than this would be found in almost every document, so they're not worth looking for
+MIN_LITERAL_LENGTH = 3
+
+# Python's parser doesn't know POSIX character classes like [[:alpha:]], and would take them for something else
+_posix_class = regex.compile(r"\[:\^?\w+:\]")
+
+def required_literals(pattern):
+    '''Returns a set of literal strings at least one of which must appear in any text the given regex can match, or None if no such set can be worked out.
+
+    The pattern is parsed with python's own regex parser, which only understands the syntax the regex
+    module shares with the re module. Anything it can't parse, or which might mean something else to
+    the regex module (fuzzy matching, POSIX character classes), or which makes literals match more
+    than their own text (case-insensitive matching), gives None, so the regex always gets run.'''
+    if pattern is None or _posix_class.search(pattern) is not None:
+        return None
+    try:
+        parsed = regex_parser.parse(pattern)
+    except Exception:
+        return None
+    if parsed.state.flags & regex_constants.SRE_FLAG_IGNORECASE:
+        return None
+    try:
+        return _sequence_literals(parsed)
+    except _Unsupported:
+        return None
+
+class _Unsupported(Exception):
+    pass
+
+def _sequence_literals(sequence):
+    '''Returns the best set of alternative literals (one of which must be present) for a sequence of parsed regex items, or None'''
+    candidates = []
+    run = []
+    for op, value in sequence:
+        if op is regex_constants.LITERAL:
+            if value in (ord("{"), ord("}")):
+                # Fuzzy matching constraints like {e<=1} look like literal braces to python's parser
+                raise _Unsupported()
+            run.append(chr(value))
+            continue
+        if len(run) > 0:
+            candidates.append({"".join(run)})
+            run = []
+        candidate = _item_literals(op, value)
+        if candidate is not None:
+            candidates.append(candidate)
+    if len(run) > 0:
+        candidates.append({"".join(run)})
+
+    candidates = [candidate for candidate in candidates if min(len(literal) for literal in candidate) >= MIN_LITERAL_LENGTH]
+    if len(candidates) == 0:
+        return None
+    # The longer the shortest literal, the rarer a match should be; and fewer alternatives are fewer chances to match
+    return max(candidates, key=lambda candidate: (min(len(literal) for literal in candidate), -len(candidate)))
+
+def _item_literals(op, value):
+    if op is regex_constants.SUBPATTERN:
+        add_flags = value[1]
+        if add_flags & regex_constants.SRE_FLAG_IGNORECASE:
+            return None
+        return _sequence_literals(value[-1])
+    if op is getattr(regex_constants, "ATOMIC_GROUP", None):
+        return _sequence_literals(value)
+    if op in (regex_constants.MAX_REPEAT, regex_constants.MIN_REPEAT, getattr(regex_constants, "POSSESSIVE_REPEAT", None)):
+        minimum, _, item = value
+        return _sequence_literals(item) if minimum >= 1 else None
+    if op is regex_constants.BRANCH:
+        literals = set()
+        for branch in value[1]:
+            branch_literals = _sequence_literals(branch)
+            if branch_literals is None:
+                return None
+            literals |= branch_literals
+        return literals
+    # Character classes, anchors, lookarounds, backreferences etc. don't contribute any literals
+    return None
+
+class RegexPrefilter:
+    '''Scans a document's content once for the required literals of every rule's metadata_regex.
+
+    A rule's full regex only needs to be run if at least one of its literals was found. All the
+    literals are combined into a single alternation, so the content is scanned once no matter how
+    many rules there are.'''
+    def __init__(self, processors):
+        self._literals = {}
+        for processor in processors:
+            literals = processor.regex_literals
+            if literals is not None:
+                self._literals[processor] = literals
+        self._all_literals = set().union(*self._literals.values())
+        self._pattern = None
+        if len(self._all_literals) > 0:
+            # Longest first, so when several literals start at the same position the one that's found contains all the others.
+            # The re module is used rather than regex, since it's quite a bit faster at plain alternations of literals.
+            alternatives = sorted(self._all_literals, key=lambda literal: (-len(literal), literal))
+            self._pattern = re.compile("|".join(re.escape(literal) for literal in alternatives))
+        # The scan doesn't report matches that overlap each other, so for each literal, these are the literals that could hide it
+        self._hidden_by = {literal: set(other for other in self._all_literals if other != literal and RegexPrefilter._can_overlap(literal, other))
+                           for literal in self._all_literals}
+
+    @staticmethod
+    def _can_overlap(literal, other):
+        '''Whether literal can start somewhere within an occurrence of other'''
+        return any(other[start:].startswith(literal) or literal.startswith(other[start:]) for start in range(len(other)))
+
+    def __len__(self):
+        return len(self._literals)
+
+    def scan(self, content):
+        '''Returns the set of literals present in the content'''
+        if self._pattern is None:
+            return set()
+        found = set(self._pattern.findall(content))
+        # A literal that wasn't reported may still be there, overlapping one that was
+        return found | set(literal for literal in self._all_literals - found if not self._hidden_by[literal].isdisjoint(found) and literal in content)
+
+    def may_match(self, processor, present):
+        '''Whether processor's regex could match content in which the given literals (from scan()) are present'''
+        literals = self._literals.get(processor)
+        return literals is None or not literals.isdisjoint(present)
@@ -0,0 +1,65 @@
+import random
+import threading
+import time
+
+class RequestController:
+    '''Adapts how many requests we make to paperless-ngx at once, and how long we wait before retrying.
+
+    The concurrency limit follows AIMD (additive increase, multiplicative decrease): every request
+    that succeeds quickly raises the limit a little, up to max_concurrency, while a request that
+    fails because the server is overloaded (or gets much slower than usual) halves it. Retries
+    wait with jittered exponential backoff, or however long the server asked us to.'''
+
+    # Statuses that mean the server is (probably temporarily) overloaded
+    overload_statuses = frozenset([429, 502, 503, 504])
+
+    def __init__(self, max_concurrency=4, max_retries=5, backoff_base=0.5, backoff_max=30.0):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_retries = max(0, int(max_retries))
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+
+        self._condition = threading.Condition()
+        self._limit = float(min(2, self.max_concurrency))
+        self._in_flight = 0
+        self._latency = None
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency, overloaded):
+        with self._condition:
+            self._in_flight -= 1
+            # A request that takes much longer than usual is treated as a (mild) sign of overload too
+            slow = self._latency is not None and latency > 3 * self._latency
+            if overloaded or slow:
+                now = time.monotonic()
+                # Only back off once per round trip, so a burst of failures from the same moment doesn't collapse the limit to 1
+                if now - self._last_decrease > (self._latency or latency):
+                    self._limit = max(1.0, self._limit / 2)
+                    self._last_decrease = now
+            else:
+                self._limit = min(float(self.max_concurrency), self._limit + 1 / self._limit)
+            if not overloaded:
+                # Exponentially weighted moving average of how long a healthy request takes
+                self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            self._condition.notify_all()
+
+    def backoff(self, attempt, retry_after=None):
+        '''How many seconds to wait before retry number attempt (counting from 0)'''
+        if retry_after is not None:
+            try:
+                return min(self._backoff_max, max(0.0, float(retry_after)))
+            except ValueError:
+                # Retry-After can also be an HTTP date, in which case we just fall back to our own backoff
+                pass
+        # "Full jitter", so clients that failed at the same time don't all retry at the same time too
+        return random.uniform(0, min(self._backoff_max, self._backoff_base * (2 ** attempt)))
@@ -0,0 +1,59 @@
+import copy
+import threading
+from collections import OrderedDict
+
+class ResponseCache:
+    '''A bounded, least-recently-used cache of the json bodies of GET responses, keyed by URL.
+
+    Along with each body, its ETag and Last-Modified headers are kept, so the next GET of the same
+    URL can be made conditional and answered with a (tiny) 304 Not Modified. Responses without
+    either header can't be revalidated, so they're reused as they are, but only until
+    forget_unvalidated() is called, since someone else may change the document in the meantime.
+    Each entry may belong to a document, and invalidate() drops everything belonging to a document
+    once we've changed it.'''
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, url):
+        '''Returns (body, validators) for url, or None if it isn't cached. validators are the headers to make a conditional GET with, and empty if the body can be used without one.'''
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            self._entries.move_to_end(url)
+            body, validators, _ = entry
+        # Callers are free to change what they get back, so they mustn't change what's cached
+        return copy.deepcopy(body), dict(validators)
+
+    def put(self, url, body, headers, document_id=None, exclude=()):
+        '''Caches body for url, without any of its keys in exclude'''
+        if self._max_entries <= 0:
+            return
+        if len(exclude) > 0 and isinstance(body, dict):
+            body = {key: value for key, value in body.items() if key not in exclude}
+        validators = {}
+        if headers.get("ETag") is not None:
+            validators["If-None-Match"] = headers["ETag"]
+        if headers.get("Last-Modified") is not None:
+            validators["If-Modified-Since"] = headers["Last-Modified"]
+        with self._lock:
+            self._entries[url] = (copy.deepcopy(body), validators, document_id)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, document_id):
+        with self._lock:
+            for url in [url for url, (_, _, entry_document_id) in self._entries.items() if entry_document_id == document_id]:
+                del self._entries[url]
+
+    def forget_unvalidated(self):
+        '''Drops the entries that can't be revalidated, so they aren't reused any longer than they can be trusted'''
+        with self._lock:
+            for url in [url for url, (_, validators, _) in self._entries.items() if len(validators) == 0]:
+                del self._entries[url]
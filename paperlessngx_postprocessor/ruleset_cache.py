@@ -0,0 +1,100 @@
+import hashlib
+import jinja2
+import os
+import pickle
+import sys
+from pathlib import Path
+
+class RulesetFingerprint:
+    def __init__(self, path, mtime_ns, size, sha256):
+        self.path = str(path)
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.sha256 = sha256
+
+    def same_stat(self, other):
+        return other is not None and self.mtime_ns == other.mtime_ns and self.size == other.size
+
+    def __eq__(self, other):
+        return isinstance(other, RulesetFingerprint) and self.path == other.path and self.sha256 == other.sha256
+
+    def __repr__(self):
+        return f"RulesetFingerprint({self.path}, sha256={self.sha256[:12]})"
+
+def stat_ruleset_file(path, previous=None):
+    '''Fingerprints a ruleset file. If its mtime and size match previous, previous's hash is reused instead of rereading the file.'''
+    stat_result = os.stat(path)
+    if previous is not None and previous.mtime_ns == stat_result.st_mtime_ns and previous.size == stat_result.st_size:
+        return RulesetFingerprint(path, stat_result.st_mtime_ns, stat_result.st_size, previous.sha256)
+    with open(path, "rb") as ruleset_file:
+        sha256 = hashlib.sha256(ruleset_file.read()).hexdigest()
+    return RulesetFingerprint(path, stat_result.st_mtime_ns, stat_result.st_size, sha256)
+
+class RulesetCache:
+    '''On-disk cache of parsed ruleset files.
+
+    For each ruleset file we store its fingerprint (path, mtime, size and content hash), the parsed
+    yaml specs, and for each of the rules' templates the python source jinja generated for it and
+    the variables it references. A file is only reparsed (and its templates recompiled) if its
+    fingerprint changed.'''
+
+    # Bump this whenever the format of the cached entries changes
+    _format_version = 2
+
+    def __init__(self, cache_dir, logger):
+        self._cache_file = Path(cache_dir) / "rulesets.cache"
+        self._logger = logger
+        self._key = (RulesetCache._format_version, jinja2.__version__, sys.version_info[:2])
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(self._cache_file, "rb") as cache_file:
+                key, entries = pickle.load(cache_file)
+            if key == self._key:
+                self._entries = entries
+            else:
+                self._logger.debug(f"Ignoring ruleset cache {self._cache_file} made by a different version")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self._logger.warning(f"Unable to read ruleset cache {self._cache_file}: {e}")
+
+    def get(self, path):
+        '''Returns (specs, compiled_templates) for the given file if the cached copy is still current, otherwise None'''
+        entry = self._entries.get(str(path))
+        if entry is None:
+            return None
+        fingerprint = stat_ruleset_file(path, entry["fingerprint"])
+        if fingerprint != entry["fingerprint"]:
+            return None
+        if not fingerprint.same_stat(entry["fingerprint"]):
+            # The file was touched but its contents didn't change, so just remember the new mtime
+            entry["fingerprint"] = fingerprint
+            self._dirty = True
+        return entry["specs"], entry["compiled_templates"]
+
+    def put(self, path, fingerprint, specs, compiled_templates):
+        self._entries[str(path)] = {"fingerprint": fingerprint,
+                                    "specs": specs,
+                                    "compiled_templates": compiled_templates}
+        self._dirty = True
+
+    def prune(self, existing_paths):
+        existing_paths = set(str(path) for path in existing_paths)
+        for path in list(self._entries.keys()):
+            if path not in existing_paths:
+                del self._entries[path]
+                self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            self._cache_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = self._cache_file.with_name(f".{self._cache_file.name}.{os.getpid()}")
+            with open(temp_file, "wb") as cache_file:
+                pickle.dump((self._key, self._entries), cache_file)
+            os.replace(temp_file, self._cache_file)
+            self._dirty = False
+        except OSError as e:
+            self._logger.warning(f"Unable to write ruleset cache {self._cache_file}: {e}")
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+
+class RunJournal:
+    '''Records which documents a run has finished, so the run can be resumed if it's interrupted.
+
+    The journal is a text file whose first line describes the run (its selectors, the fingerprint of
+    the rules, etc.) as json, followed by one finished document ID per line. Each line is flushed as
+    soon as it's written, so at most the document being processed when the run died gets processed
+    again. Runs with different selectors get different journals, so e.g. shards don't clobber each
+    other's. Once a run finishes, its journal is deleted.'''
+    def __init__(self, cache_dir, run_info):
+        self._run_info = run_info
+        # The journal is named after everything that identifies the run except the rules, so a run whose rules changed is found (and refused) rather than silently started over
+        key = json.dumps({key: value for key, value in run_info.items() if key != "rules_fingerprint"}, sort_keys=True, default=str)
+        self.path = Path(cache_dir) / "journals" / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.journal"
+        self._file = None
+
+    def load(self):
+        '''Returns (run_info, finished document IDs) from an existing journal for this run, or None if there isn't one'''
+        try:
+            with open(self.path, "r") as journal_file:
+                run_info = json.loads(journal_file.readline())
+                finished = set()
+                for line in journal_file:
+                    # The last line may be incomplete if we died while writing it
+                    if line.endswith("\n") and line.strip().isdigit():
+                        finished.add(int(line))
+        except (OSError, ValueError):
+            return None
+        return run_info, finished
+
+    def start(self, resume=False):
+        '''Starts writing the journal, either continuing the existing one or starting a new one'''
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if resume and self.path.exists():
+            self._file = open(self.path, "a")
+        else:
+            self._file = open(self.path, "w")
+            self._file.write(json.dumps(self._run_info, sort_keys=True, default=str) + "\n")
+            self._file.flush()
+
+    def record(self, document_id):
+        self._file.write(f"{document_id}\n")
+        self._file.flush()
+
+    def finish(self):
+        '''Closes and deletes the journal, since the run is complete'''
+        self.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class RunProgress:
+    '''Logs how far along a run is, how fast it's going, and when it should be done, at most every interval seconds'''
+    def __init__(self, total, logger, interval=60, already_done=0):
+        self._total = total
+        self._logger = logger
+        self._interval = interval
+        self._already_done = already_done
+        self._done = 0
+        self._start = time.monotonic()
+        self._last_report = self._start
+
+    def update(self, count=1):
+        self._done += count
+        now = time.monotonic()
+        if now - self._last_report >= self._interval or self._done == self._total:
+            self._last_report = now
+            self.report(now)
+
+    def report(self, now=None):
+        now = now if now is not None else time.monotonic()
+        elapsed = now - self._start
+        rate = self._done / elapsed if elapsed > 0 else 0.0
+        remaining = self._total - self._done
+        if rate > 0:
+            seconds_left = int(remaining / rate)
+            eta = f"{seconds_left // 3600}:{seconds_left // 60 % 60:02d}:{seconds_left % 60:02d}"
+        else:
+            eta = "unknown"
+        done_overall = self._already_done + self._done
+        total_overall = self._already_done + self._total
+        self._logger.info(f"Processed {done_overall}/{total_overall} documents ({100 * done_overall / max(1, total_overall):.1f}%), {rate:.1f} documents/s, ETA {eta}")
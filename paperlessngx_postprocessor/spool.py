@@ -0,0 +1,185 @@
+import concurrent.futures
+import fcntl
+import json
+import os
+import subprocess
+import time
+import uuid
+from pathlib import Path
+
+class SpoolQueue:
+    '''A persistent queue of jobs, stored as one json file per job in a directory.
+
+    Jobs wait in pending/ until a worker claims one by atomically moving it to working/. Finished
+    jobs are deleted, and jobs that failed too often are moved to failed/ so they can be looked at
+    later. Since everything is just files, nothing is lost if the container restarts.'''
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._pending = self.directory / "pending"
+        self._working = self.directory / "working"
+        self._failed = self.directory / "failed"
+        for subdirectory in [self._pending, self._working, self._failed]:
+            subdirectory.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    def put(self, job):
+        # Job IDs start with the time, so jobs are handled in the order they were queued
+        job_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        job = {"attempts": 0, "not_before": 0, **job}
+        self._write(self._pending / f"{job_id}.json", job)
+        return job_id
+
+    def _write(self, path, job):
+        temp_path = path.with_name(f".{path.name}.tmp")
+        # Jobs can contain things like auth tokens in their environment, so only we can read them
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as job_file:
+            json.dump(job, job_file)
+        os.replace(temp_path, path)
+
+    def pending_count(self):
+        return len(list(self._pending.glob("*.json")))
+
+    def next_ready_time(self):
+        '''Returns when the next pending job may be started (as a time.time()), or None if there are no pending jobs'''
+        times = []
+        for path in self._pending.glob("*.json"):
+            try:
+                with open(path, "r") as job_file:
+                    times.append(json.load(job_file).get("not_before", 0))
+            except (OSError, ValueError):
+                continue
+        return min(times) if len(times) > 0 else None
+
+    def claim(self):
+        '''Claims the oldest pending job that's ready to run. Returns (job_id, job), or None if there isn't one.'''
+        now = time.time()
+        for path in sorted(self._pending.glob("*.json")):
+            try:
+                with open(path, "r") as job_file:
+                    job = json.load(job_file)
+                if job.get("not_before", 0) > now:
+                    continue
+                # Renaming is atomic, so if two workers try to claim the same job only one of them succeeds
+                os.rename(path, self._working / path.name)
+            except (OSError, ValueError):
+                continue
+            return path.stem, job
+        return None
+
+    def complete(self, job_id):
+        try:
+            (self._working / f"{job_id}.json").unlink()
+        except FileNotFoundError:
+            pass
+
+    def retry(self, job_id, job, delay):
+        job["attempts"] = job.get("attempts", 0) + 1
+        job["not_before"] = time.time() + delay
+        self._write(self._pending / f"{job_id}.json", job)
+        self.complete(job_id)
+
+    def fail(self, job_id, job, error):
+        job["error"] = str(error)
+        self._write(self._failed / f"{job_id}.json", job)
+        self.complete(job_id)
+
+    def recover(self):
+        '''Puts jobs that were being worked on by a worker that died back into pending/. Only call this while holding the worker lock.'''
+        for path in self._working.glob("*.json"):
+            os.rename(path, self._pending / path.name)
+
+class WorkerLock:
+    '''An exclusive, non-blocking lock that makes sure only one worker handles a queue at a time'''
+    def __init__(self, path):
+        self._path = Path(path)
+        self._file = None
+
+    def acquire(self):
+        self._file = open(self._path, "a")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+def spawn_worker(queue, argv):
+    '''Starts argv as a worker for the given queue in the background, completely detached from us, so we can return right away.
+
+    If a worker is already running, nothing is started, since it checks for new jobs before it exits.'''
+    lock = WorkerLock(queue.directory / "worker.lock")
+    if not lock.acquire():
+        return
+    # No worker is running right now, so start one. If several of us do at once, all but one of them just exit.
+    lock.release()
+    log_file = open(queue.directory / "worker.log", "a")
+    subprocess.Popen(argv,
+                     stdin=subprocess.DEVNULL,
+                     stdout=log_file,
+                     stderr=log_file,
+                     start_new_session=True,
+                     close_fds=True)
+    log_file.close()
+
+def run_worker(queue, handler, num_workers, max_attempts, retry_delay, logger):
+    '''Runs jobs from queue with handler, num_workers at a time in separate processes, until the queue is empty.
+
+    handler must be a module-level function that takes a job and raises an exception if it failed.
+    Failed jobs are retried up to max_attempts times in total, waiting retry_delay seconds times
+    the number of attempts so far in between. If another worker already holds the queue's lock,
+    this returns immediately, since that worker will handle any new jobs too.'''
+    lock = WorkerLock(queue.directory / "worker.lock")
+    while True:
+        if not lock.acquire():
+            logger.debug(f"Another worker is already handling {queue.directory}")
+            return
+        try:
+            queue.recover()
+            _run_jobs(queue, handler, num_workers, max_attempts, retry_delay, logger)
+        finally:
+            lock.release()
+        # A job may have been queued after we saw the queue was empty but before we let go of the lock, in which case nobody would start a worker for it
+        if queue.pending_count() == 0:
+            return
+
+def _run_jobs(queue, handler, num_workers, max_attempts, retry_delay, logger):
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        while True:
+            while len(running) < num_workers:
+                claimed = queue.claim()
+                if claimed is None:
+                    break
+                job_id, job = claimed
+                logger.info(f"Starting job {job_id}")
+                running[executor.submit(handler, job)] = (job_id, job)
+
+            if len(running) == 0:
+                next_ready_time = queue.next_ready_time()
+                if next_ready_time is None:
+                    return
+                # Only jobs waiting to be retried are left, so wait for the first of them
+                time.sleep(max(0.0, min(next_ready_time - time.time(), retry_delay)) + 0.1)
+                continue
+
+            done, _ = concurrent.futures.wait(running.keys(), timeout=retry_delay, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job_id, job = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    logger.info(f"Finished job {job_id}")
+                    queue.complete(job_id)
+                elif job.get("attempts", 0) + 1 < max_attempts:
+                    delay = retry_delay * (job.get("attempts", 0) + 1)
+                    logger.warning(f"Job {job_id} failed ({error}), retrying in {delay:.0f}s")
+                    queue.retry(job_id, job, delay)
+                else:
+                    logger.error(f"Job {job_id} failed ({error}) after {max_attempts} attempts, giving up")
+                    queue.fail(job_id, job, error)
@@ -0,0 +1,49 @@
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+def sha256_file(path, chunk_size=1024*1024):
+    '''Hashes a file a chunk at a time, so even huge scans never have to fit in memory all at once'''
+    digest = hashlib.sha256()
+    with open(path, "rb") as the_file:
+        for chunk in iter(lambda: the_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class StateStore:
+    '''A small key/value store, kept in a single sqlite database, for passing state between hooks.
+
+    Entries older than max_age seconds are thrown away, so entries that are never picked up
+    (e.g. because consuming a document failed between the pre- and post-consume hooks) don't
+    pile up forever.'''
+    def __init__(self, path, max_age=7*24*60*60):
+        self._path = Path(path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._max_age = max_age
+        # Hooks for different documents can run at the same time, so wait for each other rather than failing
+        self._connection = sqlite3.connect(str(self._path), timeout=30)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT, updated REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS state_updated ON state (updated)")
+
+    def _expire(self):
+        self._connection.execute("DELETE FROM state WHERE updated < ?", (time.time() - self._max_age,))
+
+    def put(self, key, value):
+        with self._connection:
+            self._expire()
+            self._connection.execute("INSERT OR REPLACE INTO state (key, value, updated) VALUES (?, ?, ?)", (key, value, time.time()))
+
+    def get(self, key):
+        row = self._connection.execute("SELECT value FROM state WHERE key = ? AND updated >= ?", (key, time.time() - self._max_age)).fetchone()
+        return row[0] if row is not None else None
+
+    def pop(self, key):
+        with self._connection:
+            row = self._connection.execute("SELECT value FROM state WHERE key = ? AND updated >= ?", (key, time.time() - self._max_age)).fetchone()
+            self._connection.execute("DELETE FROM state WHERE key = ?", (key,))
+        return row[0] if row is not None else None
+
+    def close(self):
+        self._connection.close()
@@ -1,45 +1,102 @@
 #!/usr/bin/env python3
 
 import logging
-import ocrmypdf
 import os
 from pathlib import Path
 import regex
 import shutil
+import sys
 import tempfile
 from paperlessngx_postprocessor import Config, PaperlessAPI
+from paperlessngx_postprocessor.spool import SpoolQueue, run_worker, spawn_worker
 
-if __name__ == "__main__":
-    document_id = os.environ["DOCUMENT_ID"]
+# How much of the content to look at when deciding if a document needs to be repaired
+SAMPLE_SIZE = 64 * 1024
+# The fraction of the non-whitespace characters in the sample that have to be (cid:1234)s
+CID_THRESHOLD = 0.9
+# How many times to try repairing a document, and how long to wait after the first failure
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60
+
+def looks_like_cids(content):
+    '''Cheaply checks whether the content consists (almost) entirely of (cid:1234)s, by only looking at its beginning and end'''
+    if content is None:
+        return False
+    if len(content) > SAMPLE_SIZE:
+        content = content[:SAMPLE_SIZE // 2] + "\n" + content[-SAMPLE_SIZE // 2:]
+    if "(cid:" not in content:
+        return False
+    num_non_whitespace = len(regex.sub(r"\s+", "", content))
+    if num_non_whitespace == 0:
+        return False
+    num_cid_characters = sum(len(cid) for cid in regex.findall(r"\(cid:\d+\)", content))
+    return num_cid_characters / num_non_whitespace >= CID_THRESHOLD
+
+def repair_document(job):
+    # This is imported here because it's slow to import, and only the worker needs it
+    import ocrmypdf
+
+    config = Config(Config.general_options())
+    logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", level=config["verbose"])
+    api = PaperlessAPI(config["paperless_api_url"],
+                       auth_token = config["auth_token"],
+                       paperless_src_dir = config["paperless_src_dir"],
+                       cache_dir = config["cache_dir"])
+
+    document_id = job["document_id"]
+    logging.info(f"Repairing document_id {document_id}...")
+    with tempfile.TemporaryDirectory(prefix="cid-fixer-") as temp_dir_name:
+        temp_dir_path = Path(temp_dir_name)
+        original_filename = temp_dir_path.joinpath("original.pdf")
+        ocred_filename = temp_dir_path.joinpath("ocred.pdf")
+        shutil.copy(job["source_path"],
+                    original_filename)
+        ocrmypdf_args = {"input_file": original_filename,
+                         "output_file": ocred_filename,
+                         "progress_bar": False,
+                         "use_threads": True,
+                         "output_type": "pdf",
+                         "force_ocr": True,
+                         "jobs": job["ocr_jobs"]}
+        ocrmypdf.ocr(**ocrmypdf_args)
+        filename_to_consume = tempfile.mktemp(dir="/usr/src/paperless/consume",
+                                              suffix=".pdf")
+        shutil.copy(ocred_filename, filename_to_consume)
+        api.delete_document_by_id(document_id)
 
+    logging.info(f"  ...done repairing document_id {document_id}")
+
+if __name__ == "__main__":
     config = Config(Config.general_options())
     logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", level=config["verbose"])
 
+    # The worker does the slow OCRing in the background, so the hook itself can return right away
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        run_worker(SpoolQueue(Path(config["spool_dir"]) / "cid_fixer"),
+                   repair_document,
+                   num_workers = config["ocr_repair_workers"],
+                   max_attempts = MAX_ATTEMPTS,
+                   retry_delay = RETRY_DELAY,
+                   logger = logging.getLogger())
+        sys.exit(0)
+
+    document_id = os.environ["DOCUMENT_ID"]
+
     api = PaperlessAPI(config["paperless_api_url"],
                        auth_token = config["auth_token"],
-                       paperless_src_dir = config["paperless_src_dir"])
-
-    doc = api.get_document_by_id(document_id)
-    if regex.fullmatch("(?m)^(?:\(cid:\d+\)\s*)+$", doc["content"]) is not None:
-        logging.info(f"document_id {document_id} appears to consist entire of (cid:1234), fixing...")
-        with tempfile.TemporaryDirectory(prefix="cid-fixer-") as temp_dir_name:
-            temp_dir_path = Path(temp_dir_name)
-            original_filename = temp_dir_path.joinpath("original.pdf")
-            ocred_filename = temp_dir_path.joinpath("ocred.pdf")
-            shutil.copy(os.environ["DOCUMENT_SOURCE_PATH"],
-                        original_filename)
-            ocrmypdf_args = {"input_file": original_filename,
-                             "output_file": ocred_filename,
-                             "progress_bar": False,
-                             "use_threads": True,
-                             "output_type": "pdf",
-                             "force_ocr": True}
-            ocrmypdf.ocr(**ocrmypdf_args)
-            filename_to_consume = tempfile.mktemp(dir="/usr/src/paperless/consume",
-                                                  suffix=".pdf")
-            shutil.copy(ocred_filename, filename_to_consume)
-            api.delete_document_by_id(document_id)
-            
-        logging.info(f"  ...done")
+                       paperless_src_dir = config["paperless_src_dir"],
+                       cache_dir = config["cache_dir"])
+
+    content = api.get_document_content(document_id)
+    if looks_like_cids(content):
+        logging.info(f"document_id {document_id} appears to consist entire of (cid:1234), queueing it to be fixed")
+        # Split the cores between the documents being repaired at once
+        ocr_jobs = max(1, round((os.cpu_count() or 1) * config["ocr_repair_jobs_per_core"] / config["ocr_repair_workers"]))
+        # Only created here, so the spool directory isn't needed (or created) for the documents that don't need fixing
+        queue = SpoolQueue(Path(config["spool_dir"]) / "cid_fixer")
+        queue.put({"document_id": document_id,
+                   "source_path": os.environ["DOCUMENT_SOURCE_PATH"],
+                   "ocr_jobs": ocr_jobs})
+        spawn_worker(queue, (sys.executable, str(Path(__file__).resolve()), "--worker"))
     else:
         logging.debug(f"document_id {document_id} appeared to be OCRed successfully, so not trying again")
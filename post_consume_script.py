@@ -1,56 +1,196 @@
 #!/usr/bin/env python3
 
+import time
+# Noted before anything else is imported, so the time it takes to start up can be measured
+script_started = time.time()
+
 import logging
 import os
+import requests
 import subprocess
 import sys
+import yaml
 from pathlib import Path
 
-from paperlessngx_postprocessor import Config, PaperlessAPI, Postprocessor
+from paperlessngx_postprocessor import Config, PaperlessAPI, PaperlessAPIError, Postprocessor
+from paperlessngx_postprocessor.phase_timer import PhaseTimer
+from paperlessngx_postprocessor.spool import SpoolQueue, run_worker, spawn_worker
 
-if __name__ == "__main__":
-    directory = os.path.abspath(os.path.dirname(__file__))
+# How many times to try running a detached post-consume script, and how long to wait after the first failure
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60
+# Deferred documents are waiting for Paperless-ngx to be responsive again, so they're tried for longer, and given more time each try
+DEFERRED_MAX_ATTEMPTS = 10
+DEFERRED_RETRY_DELAY = 120
+DEFERRED_TIME_BUDGET = 600
+
+def run_post_consume_script(job):
+    # Unlike when it's run directly, a failing script is retried, so its exit code matters
+    subprocess.run(job["args"], env=job["env"], check=True)
+
+def get_logger(config):
+    logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s")
+    logger = logging.getLogger("paperlessngx_postprocessor")
+    logger.setLevel(config["verbose"])
+
+    if config["dry_run"]:
+        # Force at least info level, by choosing whichever level is lower, the given level or info (since more verbose is lower)
+        logger.setLevel(min(logging.getLevelName(config["verbose"]), logging.getLevelName("INFO")))
+        logger.info("Doing a dry run. No changes will be made.")
+    return logger
+
+def get_api(config, logger):
+    return PaperlessAPI(config["paperless_api_url"],
+                        auth_token = config["auth_token"],
+                        paperless_src_dir = config["paperless_src_dir"],
+                        cache_dir = config["cache_dir"],
+                        max_concurrency = config["max_concurrency"],
+                        max_retries = config["max_retries"],
+                        local_mirror = config["local_mirror"],
+                        response_cache_size = config["response_cache_size"],
+                        logger=logger)
+
+def postprocess(config, logger, api, document_id, timer):
+    '''Postprocesses the document, and returns it as it is afterwards, or None if there's no such document'''
+    postprocessor = Postprocessor(api,
+                                  config["rulesets_dir"],
+                                  postprocessing_tag = config["postprocessing_tag"],
+                                  invalid_tag = config["invalid_tag"],
+                                  dry_run = config["dry_run"],
+                                  skip_validation = config["skip_validation"],
+                                  logger=logger,
+                                  cache_dir = config["cache_dir"],
+                                  log_every = config["log_every"])
+    timer.lap("rule_loading", api)
+
+    document = api.get_document_by_id(document_id)
+    if not document:
+        logger.warning(f"No document found with document_id={document_id}")
+        return None
+
+    backup_documents, document = postprocessor.postprocess_document(document)
+
+    if len(backup_documents) > 0 and config["backup"] is not None:
+        logger.debug(f"Writing backup to {config['backup']}")
+        with open(config["backup"], "w") as backup_file:
+            backup_file.write(yaml.dump_all(backup_documents))
+    timer.lap("postprocessing", api)
+    return document
 
+def start_post_consume_script(config, logger, api, document_id, document, env, timer):
+    '''Runs the user's post-consume script (if there is one) with the given environment updated for the postprocessed document, or queues it to be run in the background'''
+    post_consume_script = env.get("PNGX_POSTPROCESSOR_POST_CONSUME_SCRIPT")
+    if post_consume_script is None:
+        return
+    script_env = dict(env)
+
+    script_env.update(api.get_metadata_for_post_consume_script(document_id, document=document))
+    for key in script_env:
+        if script_env[key] is None:
+            script_env[key] = "None"
+
+    script_args = [post_consume_script,
+                   script_env["DOCUMENT_ID"],
+                   script_env["DOCUMENT_FILE_NAME"],
+                   script_env["DOCUMENT_SOURCE_PATH"],
+                   script_env["DOCUMENT_THUMBNAIL_PATH"],
+                   script_env["DOCUMENT_DOWNLOAD_URL"],
+                   script_env["DOCUMENT_THUMBNAIL_URL"],
+                   script_env["DOCUMENT_CORRESPONDENT"],
+                   script_env["DOCUMENT_TAGS"]]
+    logger.debug(f"Using environment f{script_env}")
+
+    if config["detach_post_consume_script"]:
+        logger.info(f"Queueing post consume script {post_consume_script}")
+        queue = SpoolQueue(Path(config["spool_dir"]) / "post_consume_script")
+        queue.put({"document_id": document_id,
+                   "args": script_args,
+                   "env": script_env})
+        spawn_worker(queue, (sys.executable, str(Path(__file__).resolve()), "--worker"))
+    else:
+        logger.info(f"Running post consume script {post_consume_script}")
+        subprocess.run(script_args, env=script_env)
+    timer.lap("post_consume_script", api)
+
+def finish_deferred_document(job):
+    '''Does whatever the hook didn't get to for a document, because Paperless-ngx was too slow or failed.
+    Raises if Paperless-ngx still fails, so the worker tries the job again later rather than dropping it.'''
+    config = Config(Config.general_options())
+    logger = get_logger(config)
+    timer = PhaseTimer()
+    api = get_api(config, logger)
+    # Even in the background, a wedged server shouldn't block the documents queued after this one forever
+    api.set_deadline(time.monotonic() + DEFERRED_TIME_BUDGET)
+
+    document_id = job["document_id"]
+    if job["postprocessed"]:
+        document = api.get_document_by_id(document_id)
+        if not document:
+            logger.warning(f"No document found with document_id={document_id}")
+            return
+    else:
+        logger.info(f"Postprocessing deferred document_id={document_id}")
+        document = postprocess(config, logger, api, document_id, timer)
+        if document is None:
+            return
+    start_post_consume_script(config, logger, api, document_id, document, job["env"], timer)
+
+if __name__ == "__main__":
     document_id = os.environ.get("DOCUMENT_ID")
 
-    if document_id is not None:
-        subprocess.run((str(Path(directory)/"paperlessngx_postprocessor.py"),
-                        "process",
-                        "--document-id",
-                        document_id))
-
-        post_consume_script = os.environ.get("PNGX_POSTPROCESSOR_POST_CONSUME_SCRIPT")
-        if post_consume_script is not None:
-            logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s")
-            
-            config = Config(Config.general_options())
-            
-            logging.getLogger().setLevel(config["verbose"])
-            
-            script_env = os.environ.copy()
-            
-            api = PaperlessAPI(config["paperless_api_url"],
-                               auth_token = config["auth_token"],
-                               paperless_src_dir = config["paperless_src_dir"],
-                               logger=logging.getLogger())    
-            
-            script_env.update(api.get_metadata_for_post_consume_script(document_id))
-            for key in script_env:
-                if script_env[key] is None:
-                    script_env[key] = "None"
-
-            logging.info(f"Running post consume script {post_consume_script}")
-            logging.debug(f"Using environment f{script_env}")
-
-            subprocess.run((post_consume_script,
-                            script_env["DOCUMENT_ID"],
-                            script_env["DOCUMENT_FILE_NAME"],
-                            script_env["DOCUMENT_SOURCE_PATH"],
-                            script_env["DOCUMENT_THUMBNAIL_PATH"],
-                            script_env["DOCUMENT_DOWNLOAD_URL"],
-                            script_env["DOCUMENT_THUMBNAIL_URL"],
-                            script_env["DOCUMENT_CORRESPONDENT"],
-                            script_env["DOCUMENT_TAGS"]),
-                           env=script_env)
-        
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        # Runs the queued post-consume scripts in the background, so the hook itself can return right away
+        config = Config(Config.general_options())
+        logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", level=config["verbose"])
+        run_worker(SpoolQueue(Path(config["spool_dir"]) / "post_consume_script"),
+                   run_post_consume_script,
+                   num_workers = config["post_consume_script_workers"],
+                   max_attempts = MAX_ATTEMPTS,
+                   retry_delay = RETRY_DELAY,
+                   logger = logging.getLogger())
+    elif len(sys.argv) > 1 and sys.argv[1] == "--deferred-worker":
+        # Finishes the documents the hook ran out of time for, one at a time, so a struggling Paperless-ngx isn't swamped
+        config = Config(Config.general_options())
+        logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", level=config["verbose"])
+        run_worker(SpoolQueue(Path(config["spool_dir"]) / "deferred"),
+                   finish_deferred_document,
+                   num_workers = 1,
+                   max_attempts = DEFERRED_MAX_ATTEMPTS,
+                   retry_delay = DEFERRED_RETRY_DELAY,
+                   logger = logging.getLogger())
+    elif document_id is not None:
+        timer = PhaseTimer(script_started)
+        timer.lap("imports")
+
+        config = Config(Config.general_options())
+        logger = get_logger(config)
+
+        # Postprocess in this process (rather than running paperlessngx_postprocessor.py), so the document and
+        # everything looked up for it can be reused for the user's post consume script below
+        api = get_api(config, logger)
+        if config["time_budget"] is not None:
+            # The budget started when the hook did, not just now
+            api.set_deadline(time.monotonic() - (time.time() - script_started) + config["time_budget"])
+        timer.lap("auth")
+
+        postprocessed = False
+        try:
+            document = postprocess(config, logger, api, document_id, timer)
+            postprocessed = True
+            if document is not None:
+                start_post_consume_script(config, logger, api, document_id, document, os.environ.copy(), timer)
+        except (PaperlessAPIError, requests.RequestException) as e:
+            # Rather than failing (or keeping Paperless-ngx waiting), finish with the document in the background once Paperless-ngx is responsive again.
+            # This includes running out of time (DeadlineExceeded is a PaperlessAPIError), as well as failed requests.
+            logger.warning(f"Deferring document_id={document_id} to be {'postprocessed' if not postprocessed else 'finished'} in the background, since Paperless-ngx didn't answer in time or failed: {e}")
+            queue = SpoolQueue(Path(config["spool_dir"]) / "deferred")
+            queue.put({"document_id": document_id,
+                       "postprocessed": postprocessed,
+                       "env": os.environ.copy()})
+            spawn_worker(queue, (sys.executable, str(Path(__file__).resolve()), "--deferred-worker"))
+            timer.lap("deferral")
 
+        # Set by benchmarks/hook_load_test.py to find out where the time goes
+        timings_file = os.environ.get("PNGX_POSTPROCESSOR_TIMINGS_FILE")
+        if timings_file is not None:
+            timer.write(timings_file, document_id=document_id, num_requests=api.num_requests)
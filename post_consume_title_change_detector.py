@@ -1,34 +1,60 @@
 #!/usr/bin/env python3
 
-import hashlib
+import logging
 import os
+import sys
 from pathlib import Path
 from paperlessngx_postprocessor import Config, PaperlessAPI
+from paperlessngx_postprocessor.state_store import StateStore, sha256_file
+
+TAG_NAME = "Title Changed"
+
+def get_tag_id(api, state_store, use_cached=True):
+    '''Returns the ID of the tag named TAG_NAME, or None if there's no such tag'''
+    # The tag's ID is remembered (and refreshed whenever the store expires it), so we don't have to look it up every time
+    tag_id = state_store.get(f"tag_id:{TAG_NAME}") if use_cached else None
+    if tag_id is None:
+        tag_id = api.query_item_id_by_name("tags", TAG_NAME)
+        if tag_id is not None:
+            state_store.put(f"tag_id:{TAG_NAME}", str(tag_id))
+        else:
+            state_store.pop(f"tag_id:{TAG_NAME}")
+    return tag_id
+
+def add_tag(api, document_id, tag_id):
+    document = api.get_document_by_id(document_id)
+    return api.patch_document(document_id, {"tags": document["tags"] + [int(tag_id)],
+                                            "created_date": document["created_date"]})
 
 if __name__ == "__main__":
     document_id = os.environ["DOCUMENT_ID"]
 
-    filename = ""
-    with open(os.environ["DOCUMENT_SOURCE_PATH"], "rb") as the_file:
-        read_file = the_file.read()
-        filename = "." + hashlib.sha256(read_file).hexdigest()
-    
-    old_filename = None
-    with open(filename, "r") as title_file:
-        old_filename = title_file.read()
+    config = Config(Config.general_options())
+    logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", level=config["verbose"])
+
+    file_hash = sha256_file(os.environ["DOCUMENT_SOURCE_PATH"])
+    state_store = StateStore(Path(config["cache_dir"]) / "title_change_detector.sqlite3")
+
+    old_filename = state_store.pop(f"filename:{file_hash}")
+    if old_filename is None:
+        logging.warning(f"No original filename was recorded for document_id {document_id}. Did the pre-consume title change detector run?")
+        sys.exit(0)
 
     new_filename = Path(os.environ["DOCUMENT_SOURCE_PATH"]).name
     if old_filename != new_filename:
-        config = Config(Config.general_options())
         api = PaperlessAPI(config["paperless_api_url"],
                            auth_token = config["auth_token"],
-                           paperless_src_dir = config["paperless_src_dir"])
+                           paperless_src_dir = config["paperless_src_dir"],
+                           cache_dir = config["cache_dir"])
 
-        tag_id = api.get_item_id_by_name("tags", "Title Changed")
-        document = api.get_document_by_id(os.environ["DOCUMENT_ID"])
-        document["tags"].append(tag_id)
-        api.patch_document(os.environ["DOCUMENT_ID"], {"tags": document["tags"],
-                                                       "created_date": document["created_date"]})
-    
-    os.remove(filename)
+        tag_id = get_tag_id(api, state_store)
+        if tag_id is not None and not add_tag(api, document_id, tag_id).ok:
+            # The remembered ID may be stale, if the tag was deleted (or deleted and created again) since, so look it up again
+            stale_tag_id = tag_id
+            tag_id = get_tag_id(api, state_store, use_cached=False)
+            if tag_id is not None and str(tag_id) != str(stale_tag_id):
+                add_tag(api, document_id, tag_id)
+        if tag_id is None:
+            logging.warning(f"Unable to find a tag named '{TAG_NAME}'")
 
+    state_store.close()
@@ -2,13 +2,14 @@
 
 import os
 from pathlib import Path
-import hashlib
+from paperlessngx_postprocessor import Config
+from paperlessngx_postprocessor.state_store import StateStore, sha256_file
 #import magic
 #import tempfile
 #import subprocess
 
 if __name__ == "__main__":
-    filename = ""
+    config = Config(Config.general_options())
 
     # mime = magic.Magic(mime=True)
     # mime_type = mime.from_file(os.environ["DOCUMENT_SOURCE_PATH"])
@@ -20,11 +21,10 @@ if __name__ == "__main__":
     #         os.replace(temp_filename, os.environ["DOCUMENT_SOURCE_PATH"])
     # else:
     #     print(f"Mime_type of {os.environ['DOCUMENT_SOURCE_PATH']} was {mime_type}")
-                       
-    with open(os.environ["DOCUMENT_SOURCE_PATH"], "rb") as the_file:
-        read_file = the_file.read()
-        filename = "." + hashlib.sha256(read_file).hexdigest()
-    #print("preconsume is " + hashlib.sha256(os.environ["DOCUMENT_SOURCE_PATH"])
+
+    # We remember the original filename by the hash of the file's contents, so the post-consume hook can find it again
+    file_hash = sha256_file(os.environ["DOCUMENT_SOURCE_PATH"])
     document_source_path = Path(os.environ["DOCUMENT_SOURCE_PATH"])
-    with open(filename, "w") as title_file:
-        title_file.write(document_source_path.name)
+    state_store = StateStore(Path(config["cache_dir"]) / "title_change_detector.sqlite3")
+    state_store.put(f"filename:{file_hash}", document_source_path.name)
+    state_store.close()
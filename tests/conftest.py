@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The scripts import paperlessngx_postprocessor from the directory they're in, so the tests do the same
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,53 @@
+'''The created date keys rules' templates see (and the values rules end up with) must not depend on how lazily they're normalized.
+
+The expected values are what rules got before the normalization was made lazy, when the created
+date was normalized after every variable a rule updated.'''
+
+import logging
+from datetime import date
+
+import pytest
+
+from paperlessngx_postprocessor.document_metadata import DocumentMetadata
+from paperlessngx_postprocessor.postprocessor import DocumentRuleProcessor
+
+DOCUMENT = {"id": 1,
+            "archive_serial_number": None,
+            "title": "t",
+            "created": "2023-07-25T10:30:00+00:00",
+            "added": "2023-08-01T01:02:03+00:00"}
+
+CASES = [
+    # The first template still sees the created date as it came from paperless-ngx
+    ({"title": "{{ created_date_object }}"}, None,
+     "2023-07-25 10:30:00+00:00", "2023-07-25T10:00:00+00:00", date(2023, 7, 25)),
+    # Any later one sees it normalized, even if no created date key was changed
+    ({"asn": "1", "title": "{{ created_date_object }}"}, None,
+     "2023-07-25", "2023-07-25T10:00:00+00:00", date(2023, 7, 25)),
+    ({"correspondent": "X", "title": "{{ 'old' if created_date_object < date(2024,1,1) else 'new' }}"}, None,
+     "old", "2023-07-25T10:00:00+00:00", date(2023, 7, 25)),
+    # Writing a derived key directly doesn't stick, it's derived from the parts again
+    ({"created": "2001-02-03T00:00:00+00:00", "title": "{{ created }}"}, None,
+     "2023-07-25T10:00:00+00:00", "2023-07-25T10:00:00+00:00", date(2023, 7, 25)),
+    # A metadata_regex that matches normalizes it too
+    ({"title": "{{ created_date_object }}"}, r"(?P<title>t)",
+     "2023-07-25", "2023-07-25T10:00:00+00:00", date(2023, 7, 25)),
+    ({"created_month": "03", "title": "{{ created_date }} {{ created_date_object }}"}, None,
+     "2023-03-25 2023-03-25", "2023-03-25T10:00:00+00:00", date(2023, 3, 25)),
+]
+
+@pytest.mark.parametrize("metadata_postprocessing, metadata_regex, title, created, created_date_object", CASES)
+def test_rendered_metadata_matches_eager_normalization(metadata_postprocessing, metadata_regex, title, created, created_date_object):
+    spec = {"Rule": {"match": True, "metadata_postprocessing": metadata_postprocessing}}
+    if metadata_regex is not None:
+        spec["Rule"]["metadata_regex"] = metadata_regex
+    processor = DocumentRuleProcessor(None, spec, logger=logging.getLogger("test"))
+    metadata = DocumentMetadata.from_document(DOCUMENT, "C", None, None, ["a"])
+
+    new_metadata = processor.get_new_metadata(metadata, "t 09")
+
+    assert new_metadata["title"] == title
+    assert new_metadata["created"] == created
+    assert new_metadata["created_date"] == created_date_object.strftime("%F")
+    assert type(new_metadata["created_date_object"]) is date
+    assert new_metadata["created_date_object"] == created_date_object
@@ -0,0 +1,107 @@
+'''The post-consume hook defers a document to the background, rather than dropping it, when Paperless-ngx fails.'''
+
+import json
+import os
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from paperlessngx_postprocessor import PaperlessAPIError
+from paperlessngx_postprocessor.spool import WorkerLock
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+DOCUMENT = {"id": 7, "correspondent": None, "document_type": None, "storage_path": None, "archive_serial_number": None,
+            "tags": [], "title": "scan", "content": "", "created": "2023-07-25T10:30:00+00:00", "created_date": "2023-07-25",
+            "modified": "2023-07-25T10:30:00+00:00", "added": "2023-07-25T10:30:00+00:00", "original_file_name": "scan.pdf"}
+
+class FakePaperless(ThreadingHTTPServer):
+    '''Answers GETs of DOCUMENT and empty lists of everything else, with the status codes in failures (keyed by method) instead, if given'''
+    def __init__(self, failures):
+        super().__init__(("127.0.0.1", 0), FakePaperlessHandler)
+        self.failures = failures
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/api"
+
+class FakePaperlessHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/api/documents/7/"):
+            self._respond("GET", DOCUMENT)
+        else:
+            self._respond("GET", {"count": 0, "next": None, "previous": None, "results": []})
+
+    def do_PATCH(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._respond("PATCH", DOCUMENT)
+
+    def _respond(self, method, body):
+        status = self.server.failures.get(method, 200)
+        data = json.dumps(body).encode("utf-8") if status == 200 else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def fake_paperless(request):
+    server = FakePaperless(request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def environment(tmp_path, fake_paperless):
+    rulesets_dir = tmp_path / "rulesets.d"
+    rulesets_dir.mkdir()
+    (rulesets_dir / "rules.yml").write_text("Retitle:\n  match: True\n  metadata_postprocessing:\n    title: 'retitled'\n")
+    environment = {key: value for key, value in os.environ.items() if not key.startswith("PNGX_POSTPROCESSOR_")}
+    environment.update({"PNGX_POSTPROCESSOR_PAPERLESS_API_URL": fake_paperless.url,
+                        "PNGX_POSTPROCESSOR_AUTH_TOKEN": "test",
+                        "PNGX_POSTPROCESSOR_RULESETS_DIR": str(rulesets_dir),
+                        "PNGX_POSTPROCESSOR_CACHE_DIR": str(tmp_path / "cache"),
+                        "PNGX_POSTPROCESSOR_SPOOL_DIR": str(tmp_path / "spool"),
+                        "PNGX_POSTPROCESSOR_MAX_RETRIES": "0",
+                        "DOCUMENT_ID": "7"})
+    return environment
+
+def deferred_jobs(environment):
+    return [json.loads(path.read_text()) for path in (Path(environment["PNGX_POSTPROCESSOR_SPOOL_DIR"]) / "deferred" / "pending").glob("*.json")]
+
+@pytest.mark.parametrize("fake_paperless", [{"GET": 500}, {"PATCH": 500}], indirect=True)
+def test_hook_defers_document_when_paperless_fails(environment):
+    deferred_dir = Path(environment["PNGX_POSTPROCESSOR_SPOOL_DIR"]) / "deferred"
+    deferred_dir.mkdir(parents=True)
+    # Holding the worker lock keeps the hook from starting a background worker that would pick the job up
+    lock = WorkerLock(deferred_dir / "worker.lock")
+    assert lock.acquire()
+    try:
+        result = subprocess.run([sys.executable, str(REPO_DIR / "post_consume_script.py")], env=environment, capture_output=True, text=True, timeout=60)
+    finally:
+        lock.release()
+
+    assert result.returncode == 0, result.stderr
+    jobs = deferred_jobs(environment)
+    assert len(jobs) == 1
+    assert jobs[0]["document_id"] == "7"
+    assert jobs[0]["postprocessed"] is False
+
+@pytest.mark.parametrize("fake_paperless", [{"GET": 500}], indirect=True)
+def test_deferred_document_is_retried_when_paperless_still_fails(environment, monkeypatch):
+    for key, value in environment.items():
+        monkeypatch.setenv(key, value)
+    import post_consume_script
+
+    with pytest.raises(PaperlessAPIError):
+        post_consume_script.finish_deferred_document({"document_id": "7", "postprocessed": False, "env": environment})